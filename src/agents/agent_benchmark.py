@@ -0,0 +1,288 @@
+""" This module benchmarks the decision loop of the Mario Kart AI agents without Dolphin.
+
+Each benchmark runs an agent's process_frame() against a dp_fake_emulator.FakeEmulator, which reads the controller
+commands from its fifo pipe and produces frames into a shared memory ring buffer. The agent captures the frames either:
+    shared_memory: Directly from the ring buffer with a dp_frame_source.SharedMemoryFrameSource.
+    screenshot: Through the screenshot path used with a real Dolphin. The screenshot hot-key goes to a
+        SyntheticScreenshotBackend, which saves the latest fake emulator frame as a png in the screenshot folder, and
+        a dp_frame_source.ScreenshotFrameSource waits for and reads it like a Dolphin screenshot.
+
+The agent's frame source, downsampler, act() and key map are wrapped to time every stage of a decision:
+    capture: Getting the next frame from the frame source.
+    downsample: Downsampling the frame to the agent's input size.
+    act: The state lookup of MarioKartAgent or the forward pass of MarioKartNN, and choosing the keys to press.
+    key2pad: Translating the key states to controller commands, excluding the pipe write.
+    pipe_write: Writing the commands to the fifo pipe.
+    total: The whole process_frame() call.
+
+Results are written as JSON together with the commit and environment they were measured on, and compare() lists the
+stages that got slower between two result files.
+"""
+
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from src import dataset_packer, dp_fake_emulator, dp_frame_source, dp_hotkeys, helper, key2pad
+from src.agents import mk_naive_agent, mk_nn, model_export
+from src.agents.state_stats import StateStats
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('capture', 'downsample', 'act', 'key2pad', 'pipe_write', 'total')
+AGENTS = ('naive', 'nn')
+FRAME_SOURCES = ('shared_memory', 'screenshot')
+GAME_NAME = "NABE01"
+
+
+class SyntheticScreenshotBackend(dp_hotkeys.RecordingBackend):
+    """ Hot-key backend saving the latest frame of a shared memory ring buffer as a Dolphin screenshot whenever the
+    screenshot hot-key is pressed. Other hot-keys are only recorded. """
+
+    def __init__(self, ring_name, screenshot_dir, game_name=GAME_NAME, screenshot_key='f9'):
+        """ Create SyntheticScreenshotBackend instance.
+
+        Args:
+            ring_name: Name of the SharedMemoryRingBuffer the frames are read from.
+            screenshot_dir: Folder the screenshots are saved to.
+            game_name: Game ID the screenshot files are named after.
+            screenshot_key: Dolphin screenshot hot-key.
+        """
+        super().__init__()
+        self.ring = dp_frame_source.SharedMemoryRingBuffer(ring_name)
+        self.frame = np.empty(self.ring.shape, dtype=np.uint8)
+        self.screenshot_path = os.path.join(screenshot_dir, '{}-1.png'.format(game_name))
+        self.screenshot_key = screenshot_key
+
+    def key_down(self, key):
+        super().key_down(key)
+        if key == self.screenshot_key and self.ring.read_latest(self.frame):
+            # Saved under a temporary name and moved into place, so that the screenshot appears complete
+            temporary_path = self.screenshot_path + '.tmp.png'
+            cv2.imwrite(temporary_path, self.frame)
+            os.replace(temporary_path, self.screenshot_path)
+
+    def close(self):
+        self.ring.close()
+
+
+def _build_state_index(path):
+    frames, presses, counts = dataset_packer.load('mario_kart')
+    StateStats.from_frames(frames[counts - 1], presses).to_index().save(path)
+    return path
+
+
+def _build_network(directory):
+    from src.agents.mk_cnn_train import MKCNN
+    model = MKCNN(num_input_frames=1)
+    return model_export.export(model, 'benchmark_mkcnn', model.input_shape, onnx=False, directory=directory)
+
+
+def _create_agent(agent_name, model_path, frame_source, work_dir):
+    if agent_name == 'naive':
+        return mk_naive_agent.MarioKartAgent(model_path or _build_state_index(os.path.join(work_dir, 'states.npz')),
+                                             frame_source=frame_source)
+    if agent_name == 'nn':
+        return mk_nn.MarioKartNN(model_path or _build_network(work_dir), frame_source=frame_source)
+    raise ValueError("Unknown agent {}, expected one of {}.".format(agent_name, ", ".join(AGENTS)))
+
+
+def _instrument(agent, stats):
+    """ Wrap the stages of an agent's decision loop to record their latencies. Returns the list of skipped frames. """
+    skipped = []
+    next_frame = agent.frame_source.next_frame
+    downsample_image = agent.downsampler.downsample_image
+    act = agent.act
+    update = agent.key_map.update
+    write = agent.key_map.p._write
+    write_time = [0.0]
+
+    def timed_next_frame():
+        with stats['capture'].time():
+            frame = next_frame()
+        if frame is None:
+            skipped.append(time.perf_counter())
+        return frame
+
+    def timed_downsample_image(*args, **kwargs):
+        with stats['downsample'].time():
+            return downsample_image(*args, **kwargs)
+
+    def timed_act(*args, **kwargs):
+        with stats['act'].time():
+            return act(*args, **kwargs)
+
+    def timed_write(commands):
+        start = time.perf_counter()
+        writes = write(commands)
+        elapsed = time.perf_counter() - start
+        write_time[0] += elapsed
+        if writes:
+            stats['pipe_write'].add(elapsed)
+        return writes
+
+    def timed_update(keys):
+        write_time[0] = 0.0
+        start = time.perf_counter()
+        writes = update(keys)
+        stats['key2pad'].add(time.perf_counter() - start - write_time[0])
+        return writes
+
+    agent.frame_source.next_frame = timed_next_frame
+    agent.downsampler.downsample_image = timed_downsample_image
+    agent.act = timed_act
+    agent.key_map.update = timed_update
+    agent.key_map.p._write = timed_write
+    return skipped
+
+
+def run_benchmark(agent_name, frame_source_name, frames=500, fps=120, model_path=None, warmup_frames=20):
+    """ Run an agent against a fake emulator and measure its decision loop.
+
+    Args:
+        agent_name: 'naive' for mk_naive_agent.MarioKartAgent or 'nn' for mk_nn.MarioKartNN.
+        frame_source_name: 'shared_memory' or 'screenshot', see the module docstring.
+        frames: Number of process_frame() calls measured.
+        fps: Number of frames the fake emulator produces per second, which bounds the decisions per second.
+        model_path: State index or network file of the agent. Defaults to a state index of the packed dataset for the
+            naive agent and an untrained MKCNN exported to TorchScript for the neural network agent.
+        warmup_frames: Number of process_frame() calls made before measuring.
+
+    Returns:
+        Dict of the number of frames, decisions and skipped frames, the decisions per second and the latency summary of
+        each stage.
+    """
+    if frame_source_name not in FRAME_SOURCES:
+        raise ValueError("Unknown frame source {}, expected one of {}.".format(frame_source_name,
+                                                                               ", ".join(FRAME_SOURCES)))
+    work_dir = tempfile.mkdtemp(prefix='mk_benchmark_')
+    ring = dp_frame_source.SharedMemoryRingBuffer(create=True)
+    emulator = dp_fake_emulator.FakeEmulator(os.path.join(work_dir, 'dolphin'), ring.name, fps=fps)
+    emulator.start()
+    if frame_source_name == 'screenshot':
+        screenshot_dir = os.path.join(work_dir, 'dolphin', 'ScreenShots', GAME_NAME)
+        os.makedirs(screenshot_dir)
+        backend = SyntheticScreenshotBackend(ring.name, screenshot_dir)
+        frame_source = dp_frame_source.ScreenshotFrameSource(GAME_NAME, screenshot_dir=screenshot_dir)
+    else:
+        backend = dp_hotkeys.RecordingBackend()
+        frame_source = dp_frame_source.SharedMemoryFrameSource(ring.name)
+    previous_backend = dp_hotkeys.set_backend(backend)
+    agent = None
+    try:
+        agent = _create_agent(agent_name, model_path, frame_source, work_dir)
+        agent.key_map = key2pad.KeyPadMap(pipe_path=emulator.pipe_path)
+        for _ in range(warmup_frames):
+            agent.process_frame()
+
+        stats = {stage: helper.LatencyStats(max_samples=max(frames, 1)) for stage in STAGES}
+        skipped = _instrument(agent, stats)
+        start = time.perf_counter()
+        for _ in range(frames):
+            with stats['total'].time():
+                agent.process_frame()
+        elapsed = time.perf_counter() - start
+    finally:
+        dp_hotkeys.set_backend(previous_backend)
+        frame_source.close()
+        if agent is not None and agent.key_map is not None:
+            agent.key_map.p.__exit__()
+        backend.close()
+        emulator.stop()
+        ring.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    decisions = stats['key2pad'].count
+    return {"agent": agent_name, "frame_source": frame_source_name, "frames": frames, "decisions": decisions,
+            "skipped": len(skipped), "decisions_per_second": decisions / elapsed if elapsed else 0.0,
+            "stages": {stage: stats[stage].summary() for stage in STAGES}}
+
+
+def _commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.realpath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_suite(frames=500, fps=120, agents=AGENTS, frame_sources=FRAME_SOURCES):
+    """ Run the benchmark of every agent with every frame source.
+
+    Returns:
+        Dict of the commit, the environment and the run_benchmark() results keyed by '<agent>/<frame source>'.
+    """
+    results = {}
+    for agent_name in agents:
+        for frame_source_name in frame_sources:
+            logger.info("Benchmarking {} agent with {} frames.".format(agent_name, frame_source_name))
+            results['{}/{}'.format(agent_name, frame_source_name)] = run_benchmark(agent_name, frame_source_name,
+                                                                                  frames=frames, fps=fps)
+    return {"commit": _commit(), "created": time.strftime('%Y-%m-%dT%H:%M:%S%z'), "platform": platform.platform(),
+            "python": platform.python_version(), "numpy": np.__version__, "torch": torch.__version__,
+            "opencv": cv2.__version__, "cpu_count": os.cpu_count(), "frames": frames, "fps": fps,
+            "results": results}
+
+
+def write_results(suite, path):
+    with open(path, 'w') as f:
+        json.dump(suite, f, indent=2, sort_keys=True)
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, tolerance=0.1):
+    """ List the benchmarks that got slower between two run_suite() results.
+
+    Args:
+        baseline: Results to compare against, e.g. loaded from the previous commit's file.
+        current: New results.
+        tolerance: Relative slowdown of the decisions per second or of a stage's median latency that is reported.
+
+    Returns:
+        List of messages describing each slowdown.
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        if result["decisions_per_second"] < old["decisions_per_second"] * (1 - tolerance):
+            regressions.append("{}: {:.1f} -> {:.1f} decisions/s".format(name, old["decisions_per_second"],
+                                                                        result["decisions_per_second"]))
+        for stage, summary in result["stages"].items():
+            old_p50 = old["stages"].get(stage, {}).get("p50_ms")
+            if old_p50 and summary.get("p50_ms", 0.0) > old_p50 * (1 + tolerance):
+                regressions.append("{} {}: p50 {:.3f} -> {:.3f} ms".format(name, stage, old_p50, summary["p50_ms"]))
+    return regressions
+
+
+if __name__ == '__main__':
+    """ Benchmark all agents and frame sources. Usage: agent_benchmark.py [output.json [baseline.json]] """
+    logging.basicConfig(level=logging.INFO)
+    suite = run_suite()
+    for name, result in suite["results"].items():
+        logger.info("{}: {:.1f} decisions/s, {}".format(name, result["decisions_per_second"], ", ".join(
+            "{} p50 {:.3f} ms".format(stage, result["stages"][stage].get("p50_ms", 0.0)) for stage in STAGES)))
+    output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(
+        helper.get_output_folder(), "benchmark_{}.json".format((suite["commit"] or "local")[:8]))
+    write_results(suite, output_path)
+    logger.info("Results written to {}".format(output_path))
+    if len(sys.argv) > 2:
+        regressions = compare(load_results(sys.argv[2]), suite)
+        for regression in regressions:
+            logger.warning("Slower than baseline: {}".format(regression))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,138 @@
+""" This module runs one or more Mario Kart AI agents on a single asyncio event loop.
+
+Every agent instance runs as a pipeline of three stages connected by queues holding a single item:
+    1) capture: Optionally advances the Dolphin frame and waits for the next frame without blocking the event loop.
+    2) decide: Downsampling and inference through the agent's decide() method, run in a thread pool as OpenCV, numpy and
+        torch release the GIL while they work.
+    3) emit: Sends the chosen key states to Dolphin as a single controller frame through an AsyncDolphinController.
+While a frame is being decided on, the next frame is already being captured and the input of the previous one is being
+sent. The stages of all instances interleave on the same event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import time
+
+from src import dp_controller, dp_frames, helper, key2pad
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('capture', 'decide', 'emit', 'total')
+
+
+class AgentInstance:
+    """ An agent together with the Dolphin instance it controls.
+
+    Attributes:
+        agent: Agent providing a frame_source and a decide(frame) method, e.g. mk_naive_agent.MarioKartAgent.
+        controller: dp_controller.AsyncDolphinController of the instance's Dolphin pipe.
+        stats: Dict of helper.LatencyStats of each stage. 'total' is the time from requesting a frame to its input
+            being sent.
+        frames: Number of frames whose input has been sent.
+        skipped: Number of frames that could not be captured.
+    """
+
+    def __init__(self, agent, pipe_path="~/.dolphin-emu/Pipes/pipe", advance_key=None):
+        """ Create AgentInstance instance.
+
+        Args:
+            agent: Agent providing a frame_source and a decide(frame) method.
+            pipe_path: Location of the Dolphin fifo pipe of this instance.
+            advance_key: Dolphin frame advance hot-key pressed before capturing each frame, or None to let the game
+                run freely.
+        """
+        self.agent = agent
+        self.controller = dp_controller.AsyncDolphinController(pipe_path, log_commands=False)
+        self.advance_key = advance_key
+        self.stats = {stage: helper.LatencyStats() for stage in STAGES}
+        self.frames = 0
+        self.skipped = 0
+
+
+class AgentRunner:
+    """ Class running agent instances concurrently on one event loop. """
+
+    def __init__(self, instances, workers=None):
+        """ Create AgentRunner instance.
+
+        Args:
+            instances: List of AgentInstance.
+            workers: Number of threads running the decide stages, defaults to one per instance.
+        """
+        self.instances = instances
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers or len(instances))
+
+    def run(self, frames=None):
+        """ Run all instances until each has captured a number of frames, or forever if frames is None. """
+        asyncio.run(self.run_async(frames))
+
+    async def run_async(self, frames=None):
+        await asyncio.gather(*(self._run_instance(instance, frames) for instance in self.instances))
+
+    def close(self):
+        self.executor.shutdown()
+        for instance in self.instances:
+            instance.agent.frame_source.close()
+
+    def summary(self):
+        """ Return a list with the frame counts and stage latency summaries of each instance. """
+        return [dict(frames=instance.frames, skipped=instance.skipped,
+                     **{stage: stats.summary() for stage, stats in instance.stats.items()})
+                for instance in self.instances]
+
+    async def _run_instance(self, instance, frames):
+        frame_queue = asyncio.Queue(1)
+        key_queue = asyncio.Queue(1)
+        async with instance.controller:
+            await asyncio.gather(self._capture(instance, frames, frame_queue),
+                                 self._decide(instance, frame_queue, key_queue),
+                                 self._emit(instance, key_queue))
+
+    async def _capture(self, instance, frames, frame_queue):
+        loop = asyncio.get_running_loop()
+        frame_source = instance.agent.frame_source
+        count = 0
+        while frames is None or count < frames:
+            count += 1
+            start = time.perf_counter()
+            if instance.advance_key:
+                await loop.run_in_executor(self.executor, dp_frames.advance, instance.advance_key)
+            frame = await frame_source.next_frame_async()
+            if frame is None:
+                instance.skipped += 1
+                logger.warning("Frame not captured, skipping frame.")
+                continue
+            # The decide stage still holds the previous frame while the next one is captured
+            if frame_source.reuses_buffer:
+                frame = frame.copy()
+            instance.stats['capture'].add(time.perf_counter() - start)
+            await frame_queue.put((start, frame))
+        await frame_queue.put(None)
+
+    async def _decide(self, instance, frame_queue, key_queue):
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await frame_queue.get()
+            if item is None:
+                break
+            start, frame = item
+            decide_start = time.perf_counter()
+            key_states = await loop.run_in_executor(self.executor, instance.agent.decide, frame)
+            instance.stats['decide'].add(time.perf_counter() - decide_start)
+            if key_states is not None:
+                await key_queue.put((start, key_states))
+        await key_queue.put(None)
+
+    async def _emit(self, instance, key_queue):
+        while True:
+            item = await key_queue.get()
+            if item is None:
+                break
+            start, key_states = item
+            emit_start = time.perf_counter()
+            await instance.controller.send_state(key2pad.controller_state(key_states))
+            end = time.perf_counter()
+            instance.stats['emit'].add(end - emit_start)
+            instance.stats['total'].add(end - start)
+            instance.frames += 1
@@ -0,0 +1,147 @@
+""" This module evaluates Mario Kart neural networks on the validation split while they are being trained.
+
+The validation batches are collected once and kept, so every evaluation is a plain loop of forward passes over cached
+tensors. Forward passes run in eval mode, which disables dropout, and without autograd.
+
+An Evaluator either evaluates in the training process, pausing training for one pass over the cached batches, or
+evaluates asynchronously: it copies the network's weights into a snapshot and hands it to a background process, which
+evaluates the snapshots in order while training carries on.
+"""
+
+import copy
+import logging
+import queue
+
+import torch
+import torch.multiprocessing as mp
+
+logger = logging.getLogger(__name__)
+
+
+def cache_batches(loader):
+    """ Collect the (inputs, labels) batches of a loader once, with the labels flattened to (batch, keys). """
+    batches = []
+    for x, y in loader:
+        y = y.view(len(y), -1).float()
+        if torch.cuda.is_available():
+            y = y.cuda()
+        batches.append((x, y))
+    return batches
+
+
+def evaluate(model, batches, loss_func):
+    """ Return the loss of a network summed over cached validation batches.
+
+    The network is put in eval mode for the pass and back in the mode it was in afterwards.
+    """
+    training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            return sum(float(loss_func(model(x), y)) for x, y in batches)
+    finally:
+        model.train(training)
+
+
+def _evaluate_snapshots(model, batches, loss_func, snapshots, results):
+    # Leave the cores to the training process
+    torch.set_num_threads(1)
+    while True:
+        snapshot = snapshots.get()
+        if snapshot is None:
+            break
+        label, state_dict = snapshot
+        model.load_state_dict(state_dict)
+        results.put((label, evaluate(model, batches, loss_func)))
+
+
+class Evaluator:
+    """ Class evaluating a network being trained on the validation split at a fixed cadence.
+
+    Attributes:
+        losses: List of the validation losses in the order of the evaluations. Asynchronous results are added by
+            poll() and close().
+        labels: List of the labels passed to evaluate() for each loss.
+    """
+
+    def __init__(self, model, valid_loader, loss_func, every=50, asynchronous=False):
+        """ Create Evaluator instance.
+
+        Args:
+            model: Network being trained.
+            valid_loader: Iterable of (inputs, labels) validation batches, cached on creation.
+            loss_func: Loss function the networks are trained with.
+            every: Number of training steps between evaluations, see due().
+            asynchronous: Whether to evaluate weight snapshots in a background process instead of pausing training.
+        """
+        self.model = model
+        self.batches = cache_batches(valid_loader)
+        self.loss_func = loss_func
+        self.every = every
+        self.asynchronous = asynchronous
+        self.losses = []
+        self.labels = []
+        self.process = None
+        if asynchronous:
+            context = mp.get_context('spawn')
+            self.snapshots = context.Queue()
+            self.results = context.Queue()
+            background_model = copy.deepcopy(model).cpu()
+            batches = [(x.cpu(), y.cpu()) for x, y in self.batches]
+            self.process = context.Process(target=_evaluate_snapshots, daemon=True,
+                                           args=(background_model, batches, loss_func, self.snapshots, self.results))
+            self.process.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def due(self, step):
+        """ Return whether the network should be evaluated at a training step. """
+        return step % self.every == 0
+
+    def evaluate(self, label=None):
+        """ Evaluate the network in its current state.
+
+        Args:
+            label: Identifies the evaluation in labels and log messages, e.g. (epoch, step).
+
+        Returns:
+            The validation loss, or None when evaluating asynchronously.
+        """
+        if self.asynchronous:
+            state_dict = {name: tensor.detach().cpu().clone() for name, tensor in self.model.state_dict().items()}
+            self.snapshots.put((label, state_dict))
+            self.poll()
+            return None
+        loss = evaluate(self.model, self.batches, self.loss_func)
+        self._add(label, loss)
+        return loss
+
+    def poll(self):
+        """ Collect the results of finished asynchronous evaluations without waiting. """
+        while self.process is not None:
+            try:
+                self._add(*self.results.get_nowait())
+            except queue.Empty:
+                break
+
+    def close(self):
+        """ Wait for the outstanding asynchronous evaluations and stop the background process. """
+        if self.process is None:
+            return
+        self.snapshots.put(None)
+        while self.process.is_alive() or not self.results.empty():
+            try:
+                self._add(*self.results.get(timeout=0.1))
+            except queue.Empty:
+                pass
+        self.process.join()
+        self.process = None
+
+    def _add(self, label, loss):
+        self.labels.append(label)
+        self.losses.append(loss)
+        logger.info("Validation loss at {}: {:.4f}".format(label, loss))
@@ -0,0 +1,153 @@
+""" This module steps a Dolphin emulator in lock-step with a Mario Kart AI agent.
+
+The emulator is paused and only moves on when the frame advance hot-key is pressed. Rather than advancing, capturing,
+preprocessing, deciding and sending input one after the other, the FrameScheduler runs two threads:
+    1) emulator: Presses the frame advance hot-key and captures the resulting frame with the agent's frame source.
+    2) agent: Preprocesses each captured frame, decides on an action and sends it to Dolphin as controller input.
+While frame N is being preprocessed and decided on, the emulator thread already advances to and captures frame N + 1.
+The pipeline depth bounds how many captured frames may wait for a decision. The input decided for frame N is applied
+from frame N + depth + 1 onwards, so a depth of 0 steps the emulator fully serially.
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from src import dp_frames, helper, key2pad
+
+logger = logging.getLogger(__name__)
+
+STAGES = ('advance', 'capture', 'preprocess', 'act', 'emit', 'step')
+
+
+class FrameScheduler:
+    """ Class stepping a Dolphin emulator and an agent through the game in lock-step.
+
+    Attributes:
+        stats: Dict of helper.LatencyStats of each stage. 'step' is the time from advancing to a captured frame to
+            sending the input decided for it.
+        frames: Number of frames advanced.
+        decisions: Number of frames whose input has been sent.
+        skipped: Number of frames that could not be captured.
+    """
+
+    def __init__(self, agent, key_map=None, depth=1, frame_skip=0, action_repeat=1, advance_key='P'):
+        """ Create FrameScheduler instance.
+
+        Args:
+            agent: Agent providing a frame_source and preprocess(frame) and act(observation) methods, e.g.
+                mk_naive_agent.MarioKartAgent.
+            key_map: key2pad.KeyPadMap the input is sent through. Opened when the scheduler starts if not given.
+            depth: Number of captured frames that may wait for a decision while the agent works on the current one.
+            frame_skip: Number of frames advanced without capturing them after each captured frame. The last input is
+                held during the skipped frames.
+            action_repeat: Number of captured frames each decision is sent for. Every captured frame is preprocessed,
+                but the agent only acts once its last decision has been sent for action_repeat frames. Frames that
+                could not be captured do not count.
+            advance_key: Dolphin frame advance hot-key.
+        """
+        if depth < 0 or frame_skip < 0 or action_repeat < 1:
+            raise ValueError("depth and frame_skip must not be negative and action_repeat must be positive.")
+        self.agent = agent
+        self.key_map = key_map
+        self.depth = depth
+        self.frame_skip = frame_skip
+        self.action_repeat = action_repeat
+        self.advance_key = advance_key
+        self.stats = {stage: helper.LatencyStats() for stage in STAGES}
+        self.frames = 0
+        self.decisions = 0
+        self.skipped = 0
+
+    def run(self, steps=None):
+        """ Step the emulator and agent through a number of captured frames, or until stopped if steps is None.
+
+        Returns:
+            The number of decisions per second.
+        """
+        if self.key_map is None:
+            self.key_map = key2pad.KeyPadMap()
+        self.stop_event = threading.Event()
+        self.errors = []
+        # Each captured frame holds a slot until its input has been sent
+        self.slots = threading.Semaphore(self.depth + 1)
+        self.frame_queue = queue.Queue()
+        start = time.perf_counter()
+        decisions = self.decisions
+        agent_thread = threading.Thread(target=self._run_agent, daemon=True)
+        agent_thread.start()
+        try:
+            self._run_emulator(steps)
+        except Exception as e:
+            self.errors.append(e)
+        finally:
+            self.frame_queue.put(None)
+            agent_thread.join()
+        if self.errors:
+            raise self.errors[0]
+        elapsed = time.perf_counter() - start
+        return (self.decisions - decisions) / elapsed if elapsed else 0.0
+
+    def stop(self):
+        """ Stop a running scheduler after the current frame. """
+        self.stop_event.set()
+
+    def summary(self):
+        """ Return the frame counts and stage latency summaries. """
+        return dict(frames=self.frames, decisions=self.decisions, skipped=self.skipped,
+                    **{stage: stats.summary() for stage, stats in self.stats.items()})
+
+    def _run_emulator(self, steps):
+        frame_source = self.agent.frame_source
+        step = 0
+        while (steps is None or step < steps) and not self.stop_event.is_set():
+            # Wait for the decision of the frame depth + 1 frames back
+            while not self.slots.acquire(timeout=0.1):
+                if self.stop_event.is_set():
+                    return
+            start = time.perf_counter()
+            with self.stats['advance'].time():
+                for _ in range(self.frame_skip + 1):
+                    dp_frames.advance(self.advance_key)
+            self.frames += self.frame_skip + 1
+            with self.stats['capture'].time():
+                frame = frame_source.next_frame()
+            if frame is None:
+                self.skipped += 1
+                self.slots.release()
+                logger.warning("Frame not captured, skipping frame.")
+            else:
+                # The agent thread may still use the previous frame while the next one is captured
+                if frame_source.reuses_buffer:
+                    frame = frame.copy()
+                self.frame_queue.put((start, frame))
+            step += 1
+
+    def _run_agent(self):
+        key_states = None
+        repeats = 0
+        try:
+            while True:
+                item = self.frame_queue.get()
+                if item is None:
+                    break
+                start, frame = item
+                with self.stats['preprocess'].time():
+                    observation = self.agent.preprocess(frame)
+                # Frames that could not be captured never reach the agent, so they do not count as repeats
+                if key_states is None or repeats == self.action_repeat:
+                    with self.stats['act'].time():
+                        key_states = self.agent.act(observation)
+                    repeats = 0
+                if key_states is not None:
+                    with self.stats['emit'].time():
+                        self.key_map.update(key_states)
+                    self.stats['step'].add(time.perf_counter() - start)
+                    self.decisions += 1
+                    repeats += 1
+                self.slots.release()
+        except Exception as e:
+            logger.exception("Agent failed, stopping scheduler.")
+            self.errors.append(e)
+            self.stop_event.set()
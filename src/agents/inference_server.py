@@ -0,0 +1,130 @@
+""" This module implements a local inference service batching the neural network forward passes of several agents.
+
+Agents submit single observations and get back a future of the network's prediction. A server thread collects the
+requests into batches: a batch is run as soon as it is full, or once its oldest request has waited for the latency
+budget. Running one forward pass for many agents amortizes the per-call overhead of the network, which dominates at the
+small input size of the Mario Kart agents.
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+
+import torch
+
+from src import helper
+
+logger = logging.getLogger(__name__)
+
+Request = collections.namedtuple('Request', ['inputs', 'future', 'arrival'])
+
+
+class InferenceServer:
+    """ Class serving batched forward passes of a neural network from a background thread.
+
+    Attributes:
+        batch_sizes: collections.Counter of the number of requests in each batch run.
+        queue_depths: collections.Counter of the number of requests still queued whenever a batch is run.
+        latency: helper.LatencyStats of the time from submitting a request to its result being set.
+        forward: helper.LatencyStats of the time taken by each batched forward pass.
+    """
+
+    def __init__(self, model, max_batch_size=32, latency_budget=0.002):
+        """ Create InferenceServer instance and start its server thread.
+
+        Args:
+            model: Neural network module accepting a batch of stacked observations.
+            max_batch_size: Largest number of requests run in a single forward pass. Set it to the number of agents
+                sharing the server so that a batch runs as soon as every agent has submitted its observation.
+            latency_budget: Number of seconds a request may wait for more requests to join its batch.
+        """
+        self.model = model.eval()
+        self.max_batch_size = max_batch_size
+        self.latency_budget = latency_budget
+        self.requests = queue.Queue()
+        self.batch_sizes = collections.Counter()
+        self.queue_depths = collections.Counter()
+        self.latency = helper.LatencyStats()
+        self.forward = helper.LatencyStats()
+        self.thread = threading.Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, inputs):
+        """ Queue a single observation, e.g. the stacked frame history of an agent.
+
+        Returns:
+            concurrent.futures.Future of the network's output for the observation.
+        """
+        future = concurrent.futures.Future()
+        self.requests.put(Request(inputs, future, time.perf_counter()))
+        return future
+
+    def predict(self, inputs):
+        """ Return the network's output for a single observation, waiting for its batch to run. """
+        return self.submit(inputs).result()
+
+    async def predict_async(self, inputs):
+        """ Coroutine version of predict. """
+        return await asyncio.wrap_future(self.submit(inputs))
+
+    def close(self):
+        """ Stop the server thread after the queued requests have been served. """
+        self.requests.put(None)
+        self.thread.join()
+
+    def summary(self):
+        """ Return the request counts, batch size and queue depth histograms and latency summaries. """
+        batches = sum(self.batch_sizes.values())
+        requests = sum(size * count for size, count in self.batch_sizes.items())
+        return {"requests": requests, "batches": batches,
+                "mean_batch_size": requests / batches if batches else 0.0,
+                "batch_sizes": dict(sorted(self.batch_sizes.items())),
+                "queue_depths": dict(sorted(self.queue_depths.items())),
+                "latency": self.latency.summary(), "forward": self.forward.summary()}
+
+    def _serve(self):
+        running = True
+        while running:
+            request = self.requests.get()
+            if request is None:
+                break
+            batch = [request]
+            deadline = request.arrival + self.latency_budget
+            while len(batch) < self.max_batch_size:
+                try:
+                    # Requests already queued join the batch even once the budget is spent
+                    timeout = deadline - time.perf_counter()
+                    request = self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    running = False
+                    break
+                batch.append(request)
+            self.queue_depths[self.requests.qsize()] += 1
+            self._run(batch)
+
+    def _run(self, batch):
+        self.batch_sizes[len(batch)] += 1
+        try:
+            with self.forward.time(), torch.inference_mode():
+                outputs = self.model(torch.stack([request.inputs for request in batch])).cpu()
+        except Exception as e:
+            logger.exception("Batched forward pass failed.")
+            for request in batch:
+                request.future.set_exception(e)
+            return
+        end = time.perf_counter()
+        for request, output in zip(batch, outputs):
+            request.future.set_result(output)
+            self.latency.add(end - request.arrival)
@@ -3,15 +3,13 @@ This module implements a Convolutional Neural Network (CNN) Mario Kart AI Agent
 """
 
 import logging
-import os
 import matplotlib.pyplot as plt
 
 from src import helper, keylog
-from src.agents.train_valid_data import get_mario_train_valid_loader
+from src.agents import model_export, training
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 logger = logging.getLogger(__name__)
 
@@ -23,13 +21,21 @@ num_epochs = 50
 batch_size = 50
 l2_reg = 0.05
 learning_rate = 1e-5
+valid_every = 50
+async_validation = False
+bf16 = False
+world_size = 1
 
 
 class MKCNN(nn.Module):
-    def __init__(self):
-        """ Convolutional neural network (CNN) architecture of Mario Kart AI agent. """
+    def __init__(self, num_input_frames=num_input_frames):
+        """ Convolutional neural network (CNN) architecture of Mario Kart AI agent. Defaults to the module hyper
+        parameters. """
         super(MKCNN, self).__init__()
+        self.hyperparameters = dict(num_input_frames=num_input_frames)
         self.input_size = input_size
+        # Shape of a single input sample, without the batch dimension
+        self.input_shape = (num_input_frames, input_size, input_size)
         self.conv1_in, self.conv1_out, self.conv1_kernel = num_input_frames, 9, 3
         self.conv1_max_kernel = 3
         self.conv2_in, self.conv2_out, self.conv2_kernel = self.conv1_out, 6, 3
@@ -64,7 +70,7 @@ class MKCNN(nn.Module):
     def forward(self, x):
         """ Forward pass of the neural network. Accepts a tensor of size input_size*input_size. """
         x = x.view(-1, self.conv1_in, self.input_size, self.input_size)
-        x = Variable(x).float()
+        x = x.float()
         if torch.cuda.is_available():
             x = x.cuda()
         out = self.conv1(x)
@@ -76,50 +82,15 @@ class MKCNN(nn.Module):
 
 if __name__ == '__main__':
     """ Train neural network Mario Kart AI agent. """
-    mkcnn = MKCNN()
-
-    # Define gradient descent optimizer and loss function
-    optimizer = torch.optim.Adam(mkcnn.parameters(), weight_decay=l2_reg, lr=learning_rate)
-    loss_func = nn.MSELoss()
-
-    # Load data
-    train_loader, valid_loader = get_mario_train_valid_loader(batch_size, False, 123, history=num_input_frames)
-
-    # Store validation losses
-    validation_losses = []
-
-    for epoch in range(num_epochs):
-        for step, (x, y) in enumerate(train_loader):
-            # Wrap label 'y' in variable
-            y_label = y.view(-1, output_vec)
-            if torch.cuda.is_available():
-                y_label = y_label.cuda()
-            nn_label = Variable(y_label)
-
-            # Forward pass
-            forward_pass = mkcnn(x)
-            loss = loss_func(forward_pass, nn_label)  # compute loss
-            optimizer.zero_grad()  # zero gradients from previous step
-            loss.backward()  # compute gradients
-            optimizer.step()  # apply backpropagation
-
-            # Log training data
-            if step % 50 == 0:
-                print('Epoch: ', epoch, 'Step: ', step, '| training loss: %.4f' % loss.data[0])
-                valid_loss = 0
-                for (valid_x, valid_y) in valid_loader:
-                    valid_y_label = valid_y.view(-1, output_vec)
-                    if torch.cuda.is_available():
-                        valid_y_label = valid_y_label.cuda()
-                    valid_nn_label = Variable(valid_y_label)
-                    valid_forward_pass = mkcnn(valid_x)
-                    valid_loss_eval = loss_func(valid_forward_pass, valid_nn_label)  # compute validation loss
-                    valid_loss += valid_loss_eval.data[0]
-                print('Epoch: ', epoch, 'Step: ', step, '| validation loss: %.4f' % valid_loss)
-                validation_losses.append(valid_loss)
+    logging.basicConfig(level=logging.INFO)
+    name = "mkcnn_{}_frames".format(num_input_frames)
+    config = training.TrainingConfig(name, num_epochs=num_epochs, batch_size=batch_size, learning_rate=learning_rate,
+                                     l2_reg=l2_reg, valid_every=valid_every, async_validation=async_validation,
+                                     bf16=bf16, world_size=world_size)
+    mkcnn, validation_losses = training.train(MKCNN, config)
 
     # Save model
-    torch.save(mkcnn, os.path.join(helper.get_models_folder(), "mkcnn_{}_frames.pkl".format(num_input_frames)))
+    model_export.export(mkcnn, config.name, mkcnn.input_shape)
 
     # Save validation curve data
     fig_data = [validation_losses, num_input_frames, num_epochs, batch_size, learning_rate]
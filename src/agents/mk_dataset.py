@@ -1,11 +1,11 @@
-import json
 import logging
 import os
 import cv2
+import numpy as np
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
 
-from src import helper
+from src import dataset_packer, helper, label_store
 
 logger = logging.getLogger(__name__)
 
@@ -13,24 +13,23 @@ logger = logging.getLogger(__name__)
 class MarioKartDataset(Dataset):
     """Mario Kart dataset."""
 
-    def __init__(self, log_file=os.path.join(helper.get_dataset_folder(), 'mario_kart', "mario_kart.json"),
-                 transform=None, history=1):
+    def __init__(self, game_name='mario_kart', transform=None, history=1):
         """
         Args:
-            log_file: file path location to the log file containing key press states.
+            game_name: name of the master dataset folder in datasets/, its label store holds the key press states.
         """
-        self.images = os.path.join(helper.get_dataset_folder(), 'mario_kart', "images")
-        with open(log_file, 'r') as f:
-            self.data = json.load(f).get('data')
+        self.images = os.path.join(helper.get_dataset_folder(), game_name, "images")
+        store = label_store.open_game_store(game_name, create=False)
+        self.counts = store.counts()
+        self.presses = torch.from_numpy(store.presses()).float()
         self.transform = transform
         self.history = history
 
     def __len__(self):
-        return len(self.data)
+        return len(self.counts)
 
     def __getitem__(self, idx):
-        key_state = self.data[idx]
-        img_count = key_state.get('count')
+        img_count = int(self.counts[idx])
         tensors = []
         for i in range(self.history):
             img_name = os.path.join(self.images, "{}.png".format(img_count - i))
@@ -42,4 +41,74 @@ class MarioKartDataset(Dataset):
                 logger.warning("Image not found, using last tensor found")
                 tensors.append(tensors[-1])
         tensor = torch.stack(tensors)
-        return tensor, helper.get_output_vector(key_state['presses'])
+        return tensor, self.presses[idx]
+
+
+class PackedMarioKartDataset(Dataset):
+    """Mario Kart dataset backed by the memory-mapped arrays written by dataset_packer."""
+
+    def __init__(self, game_name='mario_kart', history=1):
+        """
+        Args:
+            game_name: name of the master dataset folder in datasets/.
+            history: number of consecutive frames returned per sample, most recent frame first.
+        """
+        self.frames, self.presses, self.counts = dataset_packer.load(game_name)
+        self.history = history
+
+    def __len__(self):
+        return len(self.counts)
+
+    def __getitem__(self, idx):
+        # Frames before the first image repeat the first image
+        last = int(self.counts[idx]) - 1
+        first = max(last - self.history + 1, 0)
+        # View into the memory map, no copy is made
+        tensor = torch.from_numpy(self.frames[first:last + 1])
+        if len(tensor) < self.history:
+            tensor = torch.cat([tensor[:1].expand(self.history - len(tensor), -1, -1), tensor])
+        if self.history > 1:
+            tensor = tensor.flip(0)
+        return tensor, torch.from_numpy(self.presses[idx]).float()
+
+
+class WindowedMarioKartDataset(Dataset):
+    """Mario Kart dataset preloaded into a single frame tensor and indexed by precomputed history windows."""
+
+    def __init__(self, game_name='mario_kart', history=1):
+        """
+        Args:
+            game_name: name of the master dataset folder in datasets/.
+            history: number of consecutive frames returned per sample, most recent frame first.
+        """
+        frames, presses, counts = dataset_packer.load(game_name)
+        self.frames = torch.from_numpy(np.array(frames))
+        self.presses = torch.from_numpy(np.array(presses)).float()
+        self.history = history
+        # Row i holds the frame indices of sample i, frames before the first image repeat the first image
+        last = torch.from_numpy(counts.astype(np.int64)) - 1
+        self.windows = (last.unsqueeze(1) - torch.arange(history)).clamp(min=0)
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __getitem__(self, idx):
+        """ Accepts a single index, returning a [history, H, W] window, or a tensor of indices, returning a
+        [batch, history, H, W] batch gathered with a single index operation. """
+        return self.frames[self.windows[idx]], self.presses[idx]
+
+
+class WindowBatchSampler(Sampler):
+    """ Samples whole batches of indices, to be used with WindowedMarioKartDataset and DataLoader(batch_size=None). """
+
+    def __init__(self, indices, batch_size, shuffle=True):
+        self.indices = torch.as_tensor(indices, dtype=torch.int64)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        indices = self.indices[torch.randperm(len(self.indices))] if self.shuffle else self.indices
+        return iter(indices.split(self.batch_size))
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
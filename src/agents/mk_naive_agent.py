@@ -5,18 +5,20 @@ The basic Mario Kart AI agent functions as follows:
     2) Using the state-decision map, the basic Mario Kart AI chooses an action to take by drawing a uniformly
         distributed random number between 0 and 1 and comparing it to the probability of pressing a button in a given
         state. If the random number is above the probability threshold, the action is taken. If a state has never been
-        encountered before, an action is chosen based on how often that action is taken in total out of all encountered
-        states.
+        encountered before, the probabilities of the closest encountered state are used instead. If no close state is
+        found, an action is chosen based on how often that action is taken in total out of all encountered states.
     3) The basic Mario Kart AI agent takes the desired action by sending controller inputs to the Dolphin emulator using
         fifo pipes and advancing the game by 1 frame, at which point the process starts again based on the next frame
         (state)
 """
 import logging
 import pickle
-import os
-import time
-import random
-from src import dp_screenshot, helper, mk_downsampler, key2pad, dp_frames
+
+import numpy as np
+
+from src import dp_frame_source, mk_downsampler, key2pad, dp_frames
+from src.agents.state_index import KEY_NAMES, StateIndex
+from src.agents.state_neighbours import NearestStateIndex
 
 logger = logging.getLogger(__name__)
 
@@ -25,22 +27,37 @@ class MarioKartAgent:
     """ Class implementing a basic Mario Kart AI agent using conditional probability. """
     game_name = "NABE01"
 
-    def __init__(self, pickled_model_path, delay=0.2):
+    def __init__(self, pickled_model_path, delay=0.2, frame_source=None, neighbour_time_budget=0.005):
         """ Create a MarioKart Agent instance.
 
         Args:
-            pickled_model_path: Path to the stored state-decision model file.
-            screenshot_folder: Name of the folder where the current Dolphin game's screenshots are stored.
+            pickled_model_path: Path to the stored state-decision model file, either a StateIndex .npz file or a
+                pickled StateModel.
+            delay: Maximum number of seconds to wait for Dolphin to save a screenshot when using the default frame
+                source.
+            frame_source: dp_frame_source.FrameSource providing the game frames. Defaults to Dolphin screenshots.
+            neighbour_time_budget: Number of seconds spent looking for the closest known state of an unseen frame.
+                None disables the nearest neighbour fallback.
         """
-        saved_model_file = open(pickled_model_path, 'rb')
-        saved_model_obj = pickle.load(saved_model_file)
-        self.decision_map = saved_model_obj.get("model")
-        self.default_map = saved_model_obj.get("defaults")
-        saved_model_file.close()
+        if pickled_model_path.endswith('.npz'):
+            self.state_index = StateIndex.load(pickled_model_path)
+        else:
+            with open(pickled_model_path, 'rb') as saved_model_file:
+                saved_model_obj = pickle.load(saved_model_file)
+            self.state_index = StateIndex.from_decision_map(saved_model_obj.get("model"),
+                                                            saved_model_obj.get("defaults"),
+                                                            saved_model_obj.get("state_counts"))
+        self.neighbours = None
+        if neighbour_time_budget is not None:
+            self.neighbours = NearestStateIndex(self.state_index, time_budget=neighbour_time_budget)
 
         self.frame_delay = delay
-        self.screenshot_dir = os.path.join(helper.get_home_folder(), '.dolphin-emu', 'ScreenShots', self.game_name)
-        self.key_map = key2pad.KeyPadMap()
+        if frame_source is None:
+            frame_source = dp_frame_source.ScreenshotFrameSource(self.game_name, timeout=delay)
+        self.frame_source = frame_source
+        self.downsampler = mk_downsampler.Downsampler(self.game_name, final_dim=15)
+        # Opened on the first processed frame, agents run by agent_runner send their input through its controllers
+        self.key_map = None
         self.key_states = dict()
 
     def process_frame(self):
@@ -53,33 +70,51 @@ class MarioKartAgent:
         # Advance the Dolphin frame
         dp_frames.advance('P')
 
-        # Take screenshot of current Dolphin frame
-        dp_screenshot.take_screenshot()
-        screenshot_file = os.path.join(self.screenshot_dir, 'NABE01-1.png')
-        time.sleep(self.frame_delay)
-
-        try:
-            # Downsample the screenshot and calculate dictionary key
-            ds_image = mk_downsampler.Downsampler(self.game_name, final_dim=15).downsample(screenshot_file)
-
-            state_key = helper.generate_img_key(ds_image)
-
-            # Look up the game state to decide which action to take.
-            if state_key in self.decision_map:
-                # Choose which action to take using the key press probabilities in the decision map
-                for key_name in self.decision_map[state_key]:
-                    rand_num = random.uniform(0, 1)
-                    self.key_states[key_name] = self.decision_map[state_key][key_name] > rand_num
-            else:
-                # Choose which action to take using the key press probabilities in the default map
-                for key_name in self.default_map:
-                    rand_num = random.uniform(0, 1)
-                    self.key_states[key_name] = self.default_map[key_name] > rand_num
-
-            # Send updated key states to the Dolphin controller
-            self.key_map.update(self.key_states)
-
-            # Delete used screenshot file
-            os.unlink(screenshot_file)
-        except (IOError, FileNotFoundError):
+        # Capture current Dolphin frame
+        frame = self.frame_source.next_frame()
+        if frame is None:
             logger.warning("Screenshot not found, skipping frame.")
+            return
+
+        # Decide which keys to press
+        self.key_states = self.decide(frame)
+
+        # Send updated key states to the Dolphin controller
+        if self.key_map is None:
+            self.key_map = key2pad.KeyPadMap()
+        self.key_map.update(self.key_states)
+
+    def decide(self, frame):
+        """ Choose which keys to press in a captured Dolphin frame.
+
+        Args:
+            frame: BGR uint8 frame.
+
+        Returns:
+            Dict of key press states keyed by keylog.Keyboard names.
+        """
+        return self.act(self.preprocess(frame))
+
+    def preprocess(self, frame):
+        """ Return the downsampled image of a captured Dolphin frame. """
+        return self.downsampler.downsample_image(frame)
+
+    def act(self, ds_image):
+        """ Choose which keys to press in a downsampled frame.
+
+        Returns:
+            Dict of key press states keyed by keylog.Keyboard names.
+        """
+        # Look up the game state to decide which action to take. Unseen states use the closest known state, or the
+        # default key press probabilities if there is none
+        state_id = self.state_index.state_id(ds_image)
+        if state_id is None and self.neighbours is not None:
+            state_id, _ = self.neighbours.query(ds_image)
+        if state_id is None:
+            probabilities = self.state_index.defaults
+        else:
+            probabilities = self.state_index.probabilities[state_id]
+
+        # Choose which action to take using the key press probabilities
+        key_presses = probabilities > np.random.uniform(0, 1, len(probabilities))
+        return dict(zip(KEY_NAMES, key_presses.tolist()))
@@ -3,12 +3,11 @@ This module implements a Mario Kart AI agent using a Neural Network.
 """
 import collections
 import logging
-import os
-import time
 
 import torch
 
-from src import dp_screenshot, helper, mk_downsampler, key2pad
+from src import dp_frame_source, helper, mk_downsampler, key2pad
+from src.agents import model_export
 
 logger = logging.getLogger(__name__)
 
@@ -17,16 +16,31 @@ class MarioKartNN:
     """ Class implementing a neural network Mario Kart AI agent """
     game_name = "NABE01"
 
-    def __init__(self, pickled_model_path, history_length=1, delay=0.2):
+    def __init__(self, pickled_model_path, history_length=1, delay=0.2, frame_source=None, inference_server=None):
         """ Create a MarioKart Agent instance.
         Args:
-            pickled_model_path: Path to the neural network model file.
+            pickled_model_path: Path to the neural network model file, either a .ts or .onnx file exported with
+                model_export or a pickled network. Not needed when using an inference server.
+            delay: Maximum number of seconds to wait for Dolphin to save a screenshot when using the default frame
+                source.
+            frame_source: dp_frame_source.FrameSource providing the game frames. Defaults to Dolphin screenshots.
+            inference_server: Optional inference_server.InferenceServer shared with other agents that runs the
+                forward passes instead of the agent's own model.
         """
-        self.model = torch.load(pickled_model_path)
+        self.inference_server = inference_server
+        self.model = None
+        if inference_server is None and pickled_model_path.endswith(('.ts', '.onnx')):
+            self.model = model_export.load_inference_model(pickled_model_path)
+        elif inference_server is None:
+            self.model = model_export.load_pickled_model(pickled_model_path).eval()
 
         self.frame_delay = delay
-        self.screenshot_dir = os.path.join(helper.get_home_folder(), '.dolphin-emu', 'ScreenShots', self.game_name)
-        self.key_map = key2pad.KeyPadMap()
+        if frame_source is None:
+            frame_source = dp_frame_source.ScreenshotFrameSource(self.game_name, timeout=delay)
+        self.frame_source = frame_source
+        self.downsampler = mk_downsampler.Downsampler(self.game_name, final_dim=15)
+        # Opened on the first processed frame, agents run by agent_runner send their input through its controllers
+        self.key_map = None
         self.history_length = history_length
         self.previous_tensors = collections.deque([], history_length)
 
@@ -39,43 +53,73 @@ class MarioKartNN:
         # Advance the Dolphin frame
         # dp_frames.advance('P')
 
-        # Take screenshot of current Dolphin frame
-        dp_screenshot.take_screenshot()
-        screenshot_file = os.path.join(self.screenshot_dir, 'NABE01-1.png')
-        # time.sleep(self.frame_delay)
+        # Capture current Dolphin frame
+        frame = self.frame_source.next_frame()
+        if frame is None:
+            logger.warning("Screenshot not found, skipping frame.")
+            return
 
-        try:
-            # Downsample the screenshot and calculate dictionary key
-            ds_image = mk_downsampler.Downsampler(self.game_name, final_dim=15).downsample(screenshot_file)
+        key_state = self.decide(frame)
+        if key_state is None:
+            return
 
-            # Generate tensor from image
-            x = helper.get_tensor(ds_image)
+        # Send updated key states to the Dolphin controller
+        if self.key_map is None:
+            self.key_map = key2pad.KeyPadMap()
+        self.key_map.update(key_state)
 
-            if x is None:
-                logger.info("Skipping frame - no input received.")
-                return
+    def decide(self, frame):
+        """ Choose which keys to press in a captured Dolphin frame.
 
-            # add tensor to history
-            self.previous_tensors.appendleft(x)
-            # do not continue if not enough tensor history has been filled
-            if len(self.previous_tensors) != self.history_length:
-                logger.info("Skipping frame - not enough inputs yet")
-                return
+        Args:
+            frame: BGR uint8 frame.
 
-            # stack tensors
-            tensors = torch.stack(self.previous_tensors)
+        Returns:
+            Dict of key press states keyed by keylog.Keyboard names, or None if no decision can be made yet.
+        """
+        return self.act(self.preprocess(frame))
 
-            # Predict key presses using neural network
-            prediction = self.model(tensors)
+    def preprocess(self, frame):
+        """ Add a captured Dolphin frame to the frame history.
 
-            # Choose which action to take from prediction
-            key_state = helper.get_key_state_from_vector(prediction)
+        Returns:
+            The stacked tensors of the frame history, or None if the history is not complete yet.
+        """
+        # Downsample the frame
+        ds_image = self.downsampler.downsample_image(frame)
 
-            # Send updated key states to the Dolphin controller
-            self.key_map.update(key_state)
+        # Generate tensor from image
+        x = helper.get_tensor(ds_image)
 
-            # Delete used screenshot file
-            os.unlink(screenshot_file)
+        if x is None:
+            logger.info("Skipping frame - no input received.")
+            return None
 
-        except (IOError, FileNotFoundError):
-            logger.warning("Screenshot not found, skipping frame.")
+        # add tensor to history
+        self.previous_tensors.appendleft(x)
+        # do not continue if not enough tensor history has been filled
+        if len(self.previous_tensors) != self.history_length:
+            logger.info("Skipping frame - not enough inputs yet")
+            return None
+
+        # stack tensors
+        return torch.stack(list(self.previous_tensors))
+
+    def act(self, tensors):
+        """ Choose which keys to press given the stacked frame history from preprocess().
+
+        Returns:
+            Dict of key press states keyed by keylog.Keyboard names, or None if no decision can be made yet.
+        """
+        if tensors is None:
+            return None
+
+        # Predict key presses using neural network
+        if self.inference_server is not None:
+            prediction = self.inference_server.predict(tensors).unsqueeze(0)
+        else:
+            with torch.inference_mode():
+                prediction = self.model(tensors)
+
+        # Choose which action to take from prediction
+        return helper.get_key_state_from_vector(prediction)
@@ -3,15 +3,13 @@ This module implements a Neural Network (NN) Mario Kart AI Agent using PyTorch.
 """
 
 import logging
-import os
 import matplotlib.pyplot as plt
 
 from src import helper, keylog
-from src.agents.train_valid_data import get_mario_train_valid_loader
+from src.agents import model_export, training
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 logger = logging.getLogger(__name__)
 
@@ -25,13 +23,21 @@ num_epochs = 50
 batch_size = 50
 l2_reg = 0.05
 learning_rate = 1e-5
+valid_every = 50
+async_validation = False
+bf16 = False
+world_size = 1
 
 
 class MKNN(nn.Module):
-    def __init__(self):
-        """ Neural network (NN) architecture of Mario Kart AI agent. """
+    def __init__(self, hidden_size_1=hidden_size_1, hidden_size_2=hidden_size_2, hidden_size_3=hidden_size_3):
+        """ Neural network (NN) architecture of Mario Kart AI agent. Defaults to the module hyper parameters. """
         super(MKNN, self).__init__()
+        self.hyperparameters = dict(hidden_size_1=hidden_size_1, hidden_size_2=hidden_size_2,
+                                    hidden_size_3=hidden_size_3)
         self.input_size = input_size
+        # Shape of a single input sample, without the batch dimension
+        self.input_shape = (1, input_size, input_size)
         self.hidden_size_1 = hidden_size_1
         self.hidden_size_2 = hidden_size_2
         self.hidden_size_3 = hidden_size_3
@@ -59,57 +65,21 @@ class MKNN(nn.Module):
         x_input = x.view(-1, self.input_size * self.input_size)
         if torch.cuda.is_available():
             x_input = x_input.cuda()
-        x = Variable(x_input).float()
+        x = x_input.float()
         encoded = self.encoder(x)
         return encoded
 
 
 if __name__ == '__main__':
     """ Train neural network Mario Kart AI agent. """
-    mknn = MKNN()
-
-    # Define gradient descent optimizer and loss function
-    optimizer = torch.optim.Adam(mknn.parameters(), weight_decay=l2_reg, lr=learning_rate)
-    loss_func = nn.MSELoss()
-
-    # Load data
-    train_loader, valid_loader = get_mario_train_valid_loader(batch_size, False, 123)
-
-    # Store validation losses
-    validation_losses = []
-
-    for epoch in range(num_epochs):
-        for step, (x, y) in enumerate(train_loader):
-            # Wrap label 'y' in variable
-            y_label = y.view(-1, output_vec)
-            if torch.cuda.is_available():
-                y_label = y_label.cuda()
-            nn_label = Variable(y_label)
-
-            # Forward pass
-            forward_pass = mknn(x)
-            loss = loss_func(forward_pass, nn_label)  # compute loss
-            optimizer.zero_grad()  # zero gradients from previous step
-            loss.backward()  # compute gradients
-            optimizer.step()  # apply backpropagation
-
-            # Log training data
-            if step % 50 == 0:
-                print('Epoch: ', epoch, 'Step: ', step, '| training loss: %.4f' % loss.data[0])
-                valid_loss = 0
-                for (valid_x, valid_y) in valid_loader:
-                    valid_y_label = valid_y.view(-1, output_vec)
-                    if torch.cuda.is_available():
-                        valid_y_label = valid_y_label.cuda()
-                    valid_nn_label = Variable(valid_y_label)
-                    valid_forward_pass = mknn(valid_x)
-                    valid_loss_eval = loss_func(valid_forward_pass, valid_nn_label)  # compute validation loss
-                    valid_loss += valid_loss_eval.data[0]
-                print('Epoch: ', epoch, 'Step: ', step, '| validation loss: %.4f' % valid_loss)
-                validation_losses.append(valid_loss)
+    logging.basicConfig(level=logging.INFO)
+    config = training.TrainingConfig("mknn", num_epochs=num_epochs, batch_size=batch_size,
+                                     learning_rate=learning_rate, l2_reg=l2_reg, valid_every=valid_every,
+                                     async_validation=async_validation, bf16=bf16, world_size=world_size)
+    mknn, validation_losses = training.train(MKNN, config)
 
     # Save model
-    torch.save(mknn, os.path.join(helper.get_models_folder(), "mknn.pkl"))
+    model_export.export(mknn, config.name, mknn.input_shape)
 
     # Save validation curve data
     fig_data = [validation_losses, num_epochs, batch_size, learning_rate]
@@ -4,15 +4,13 @@ Long Short-Term Memory (LSTM) and PyTorch.
 """
 
 import logging
-import os
 import matplotlib.pyplot as plt
 
 from src import helper, keylog
-from src.agents.train_valid_data import get_mario_train_valid_loader
+from src.agents import model_export, training
 
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 
 logger = logging.getLogger(__name__)
 
@@ -27,13 +25,23 @@ num_epochs = 50
 batch_size = 50
 l2_reg = 0.05
 learning_rate = 1e-5
+valid_every = 50
+async_validation = False
+bf16 = False
+world_size = 1
 
 
 class MKRNN_lstm(nn.Module):
-    def __init__(self):
-        """ Recurrent Neural Network (RNN) architecture of Mario Kart AI agent with LSTM. """
+    def __init__(self, history=history, hidden_size_1=hidden_size_1, hidden_size_2=hidden_size_2,
+                 hidden_size_3=hidden_size_3):
+        """ Recurrent Neural Network (RNN) architecture of Mario Kart AI agent with LSTM. Defaults to the module hyper
+        parameters. """
         super(MKRNN_lstm, self).__init__()
+        self.hyperparameters = dict(history=history, hidden_size_1=hidden_size_1, hidden_size_2=hidden_size_2,
+                                    hidden_size_3=hidden_size_3)
         self.input_size = input_size
+        # Shape of a single input sample, without the batch dimension
+        self.input_shape = (history, input_size, input_size)
         self.history = history
         self.hidden_size_1 = hidden_size_1
         self.hidden_size_2 = hidden_size_2
@@ -63,7 +71,7 @@ class MKRNN_lstm(nn.Module):
         x_input = x.view(-1, self.history, self.input_size * self.input_size)
         if torch.cuda.is_available():
             x_input = x_input.cuda()
-        x = Variable(x_input).float()
+        x = x_input.float()
         out, _ = self.lstm(x)
         out = out.view(-1, self.history * self.hidden_size_1)
         encoded = self.encoder(out)
@@ -72,50 +80,14 @@ class MKRNN_lstm(nn.Module):
 
 if __name__ == '__main__':
     """ Train neural network Mario Kart AI agent. """
-    mkrnn = MKRNN_lstm()
-
-    # Define gradient descent optimizer and loss function
-    optimizer = torch.optim.Adam(mkrnn.parameters(), weight_decay=l2_reg, lr=learning_rate)
-    loss_func = nn.MSELoss()
-
-    # Load data
-    train_loader, valid_loader = get_mario_train_valid_loader(batch_size, False, 123, history=history)
-
-    # Store validation losses
-    validation_losses = []
-
-    for epoch in range(num_epochs):
-        for step, (x, y) in enumerate(train_loader):
-            # Wrap label 'y' in variable
-            y_label = y.view(-1, output_vec)
-            if torch.cuda.is_available():
-                y_label = y_label.cuda()
-            nn_label = Variable(y_label)
-
-            # Forward pass
-            forward_pass = mkrnn(x)
-            loss = loss_func(forward_pass, nn_label)  # compute loss
-            optimizer.zero_grad()  # zero gradients from previous step
-            loss.backward()  # compute gradients
-            optimizer.step()  # apply backpropagation
-
-            # Log training data
-            if step % 50 == 0:
-                print('Epoch: ', epoch, 'Step: ', step, '| training loss: %.4f' % loss.data[0])
-                valid_loss = 0
-                for (valid_x, valid_y) in valid_loader:
-                    valid_y_label = valid_y.view(-1, output_vec)
-                    if torch.cuda.is_available():
-                        valid_y_label = valid_y_label.cuda()
-                    valid_nn_label = Variable(valid_y_label)
-                    valid_forward_pass = mkrnn(valid_x)
-                    valid_loss_eval = loss_func(valid_forward_pass, valid_nn_label)  # compute validation loss
-                    valid_loss += valid_loss_eval.data[0]
-                print('Epoch: ', epoch, 'Step: ', step, '| validation loss: %.4f' % valid_loss)
-                validation_losses.append(valid_loss)
+    logging.basicConfig(level=logging.INFO)
+    config = training.TrainingConfig("mkrnn_{}_lstm".format(history), num_epochs=num_epochs, batch_size=batch_size,
+                                     learning_rate=learning_rate, l2_reg=l2_reg, valid_every=valid_every,
+                                     async_validation=async_validation, bf16=bf16, world_size=world_size)
+    mkrnn, validation_losses = training.train(MKRNN_lstm, config)
 
     # Save model
-    torch.save(mkrnn, os.path.join(helper.get_models_folder(), "mkrnn_{}_lstm.pkl".format(history)))
+    model_export.export(mkrnn, config.name, mkrnn.input_shape)
 
     # Save validation curve data
     fig_data = [validation_losses, history, num_epochs, batch_size, learning_rate]
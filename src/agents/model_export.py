@@ -0,0 +1,151 @@
+""" This module exports trained Mario Kart neural networks for inference and loads the exported files.
+
+An exported model named <name> consists of up to three files in the models folder:
+    <name>.pt: The state dict of the network together with the import path of its class, its constructor hyper
+        parameters and its input shape. Plain tensors and values only, so it loads with torch.load(weights_only=True).
+    <name>.ts: A traced and frozen TorchScript graph of the network in eval mode.
+    <name>.onnx: An ONNX graph of the network, if ONNX export is available.
+
+load_inference_model() runs the .ts or .onnx files without importing the training modules, which probe for CUDA and
+import matplotlib at import time. The training modules are only imported when exporting.
+"""
+
+import importlib
+import logging
+import os
+import pickle
+import types
+
+import torch
+
+from src import helper
+
+logger = logging.getLogger(__name__)
+
+# Training module classes of the networks, also under the names they were pickled with when trained as __main__
+MODEL_CLASSES = {
+    'MKNN': 'src.agents.mk_nn_train.MKNN',
+    'MKCNN': 'src.agents.mk_cnn_train.MKCNN',
+    'MKRNN': 'src.agents.mk_rnn_lstm_train.MKRNN_lstm',
+    'MKRNN_lstm': 'src.agents.mk_rnn_lstm_train.MKRNN_lstm',
+    'MKRCNN': 'src.agents.mk_crnn_gru_train.MKCRNN_gru',
+    'MKCRNN_gru': 'src.agents.mk_crnn_gru_train.MKCRNN_gru',
+    'MKCRNN_lstm': 'src.agents.mk_crnn_lstm_train.MKCRNN_lstm',
+}
+
+
+def import_class(class_path):
+    """ Return the class at an import path such as src.agents.mk_cnn_train.MKCNN. """
+    module_name, class_name = class_path.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class _LegacyUnpickler(pickle.Unpickler):
+    """ Unpickler resolving networks pickled by a training script run as __main__ to their training module class. """
+
+    def find_class(self, module, name):
+        if module == '__main__' and name in MODEL_CLASSES:
+            return import_class(MODEL_CLASSES[name])
+        return super().find_class(module, name)
+
+
+def load_pickled_model(path):
+    """ Load a whole pickled network as saved by the training scripts with torch.save, on the CPU. """
+    legacy_pickle = types.SimpleNamespace(Unpickler=_LegacyUnpickler, load=pickle.load, __name__='pickle')
+    return torch.load(path, map_location='cpu', weights_only=False, pickle_module=legacy_pickle)
+
+
+def export(model, name, input_shape, onnx=True, directory=None):
+    """ Export a trained network for inference.
+
+    Args:
+        model: Trained network, an instance of one of the training module classes.
+        name: Base name of the exported files.
+        input_shape: Shape of a single input without the batch dimension, e.g. (history, 15, 15).
+        onnx: Whether to also export an ONNX graph.
+        directory: Folder the files are written to, defaults to the models folder.
+
+    Returns:
+        The path of the TorchScript file.
+    """
+    directory = directory or helper.get_models_folder()
+    model = model.cpu().eval()
+    class_path = '{}.{}'.format(type(model).__module__, type(model).__name__)
+    if type(model).__module__ == '__main__':
+        # Exported by a training script run as a script
+        class_path = MODEL_CLASSES[type(model).__name__]
+    torch.save({'class': class_path, 'input_shape': list(input_shape),
+                'hyperparameters': getattr(model, 'hyperparameters', {}), 'state_dict': model.state_dict()},
+               os.path.join(directory, '{}.pt'.format(name)))
+
+    example = torch.zeros((1,) + tuple(input_shape))
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, example))
+    ts_path = os.path.join(directory, '{}.ts'.format(name))
+    torch.jit.save(traced, ts_path)
+
+    if onnx:
+        onnx_path = os.path.join(directory, '{}.onnx'.format(name))
+        try:
+            torch.onnx.export(model, (example,), onnx_path, input_names=['input'], output_names=['output'],
+                              dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}}, dynamo=False)
+        except Exception as e:
+            logger.warning("ONNX export of {} failed ({}), only the TorchScript graph is available.".format(name, e))
+    logger.info("Exported {} to {}".format(class_path, ts_path))
+    return ts_path
+
+
+def load_state_dict_model(path):
+    """ Rebuild a network from an exported .pt file, importing its training module class. """
+    exported = torch.load(path, map_location='cpu', weights_only=True)
+    model = import_class(exported['class'])(**exported.get('hyperparameters', {})).cpu()
+    model.load_state_dict(exported['state_dict'])
+    return model
+
+
+class OnnxModel:
+    """ Callable running an exported ONNX graph with onnxruntime on torch tensors. """
+
+    def __init__(self, path):
+        import onnxruntime
+        self.session = onnxruntime.InferenceSession(path, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def eval(self):
+        return self
+
+    def __call__(self, x):
+        output = self.session.run(None, {self.input_name: x.float().numpy()})[0]
+        return torch.from_numpy(output)
+
+
+def load_inference_model(path):
+    """ Load an exported network for inference without importing its training module.
+
+    Args:
+        path: Path of an exported .ts or .onnx file.
+
+    Returns:
+        A callable taking a batch of inputs as a tensor and returning the network's output tensor.
+    """
+    if path.endswith('.onnx'):
+        return OnnxModel(path)
+    # The graph is frozen already. torch.jit.optimize_for_inference converts it to mkldnn layouts, which costs more than
+    # it saves at the network sizes used here
+    return torch.jit.load(path, map_location='cpu')
+
+
+if __name__ == '__main__':
+    """ Export the pickled networks in the models folder that can still be loaded. """
+    logging.basicConfig(level=logging.INFO)
+    models_folder = helper.get_models_folder()
+    for file_name in sorted(os.listdir(models_folder)):
+        if not file_name.endswith('.pkl'):
+            continue
+        try:
+            model = load_pickled_model(os.path.join(models_folder, file_name))
+            # Networks with convolutions take frames as channels, the others a history of frames
+            frames = getattr(model, 'conv1_in', None) or getattr(model, 'history', 1)
+            export(model, file_name[:-len('.pkl')], (frames, 15, 15))
+        except Exception as e:
+            logger.warning("Could not export {}: {}".format(file_name, e))
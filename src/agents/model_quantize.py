@@ -0,0 +1,151 @@
+""" This module quantizes exported Mario Kart neural networks to int8 for CPU inference.
+
+Post-training quantization is applied in two passes:
+    1) static: The convolution blocks of MKCNN, MKCRNN_gru and MKCRNN_lstm are wrapped between a QuantStub and a
+        DeQuantStub, observed on frames of the packed dataset and converted to int8 convolutions.
+    2) dynamic: The Linear, LSTM and GRU layers of every network get int8 weights, their activations are quantized on
+        the fly from the range of each input.
+The quantized network is traced and saved as <name>_int8.ts next to the exported float network, so that MarioKartNN
+and model_export.load_inference_model load it like any other TorchScript file.
+"""
+
+import logging
+import os
+
+import torch
+import torch.nn as nn
+from torch.ao import quantization
+
+from src import helper
+from src.agents import model_export
+from src.agents.train_valid_data import get_mario_train_valid_loader
+
+logger = logging.getLogger(__name__)
+
+DYNAMIC_LAYERS = {nn.Linear, nn.LSTM, nn.GRU}
+
+
+class _Contiguous(nn.Module):
+    """ Restores the contiguous layout of dequantized convolution output, which the forward passes view() into. """
+
+    def forward(self, x):
+        return x.contiguous()
+
+
+def quantize(model, calibration_batches):
+    """ Quantize a trained network to int8.
+
+    Args:
+        model: Trained network, an instance of one of the training module classes. It is modified in place.
+        calibration_batches: Iterable of input batches the activation ranges of the convolutions are observed on.
+
+    Returns:
+        The quantized network in eval mode.
+    """
+    model = model.cpu().eval()
+    if hasattr(model, 'conv1'):
+        # Both blocks run back to back in the forward passes, so their output stays quantized in between
+        model.conv1 = nn.Sequential(quantization.QuantStub(), model.conv1)
+        model.conv2 = nn.Sequential(model.conv2, quantization.DeQuantStub(), _Contiguous())
+        qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+        model.conv1.qconfig = model.conv2.qconfig = qconfig
+        quantization.prepare(model, inplace=True)
+        with torch.no_grad():
+            for x in calibration_batches:
+                model(x)
+        quantization.convert(model, inplace=True)
+    return quantization.quantize_dynamic(model, DYNAMIC_LAYERS, dtype=torch.qint8)
+
+
+def export(model, name, input_shape, directory=None):
+    """ Trace a quantized network and save it as <name>_int8.ts.
+
+    Args:
+        model: Quantized network returned by quantize.
+        name: Base name of the exported float network.
+        input_shape: Shape of a single input without the batch dimension.
+        directory: Folder the file is written to, defaults to the models folder.
+
+    Returns:
+        The path of the TorchScript file.
+    """
+    directory = directory or helper.get_models_folder()
+    with torch.no_grad():
+        traced = torch.jit.freeze(torch.jit.trace(model, torch.zeros((1,) + tuple(input_shape))))
+    ts_path = os.path.join(directory, '{}_int8.ts'.format(name))
+    torch.jit.save(traced, ts_path)
+    logger.info("Exported quantized {} to {}".format(name, ts_path))
+    return ts_path
+
+
+def benchmark(models, valid_batches, input_shape, frames=1000):
+    """ Compare the single frame latency and the validation loss of networks.
+
+    Args:
+        models: Dict of callables taking a batch of inputs, e.g. loaded with model_export.load_inference_model, keyed
+            by name.
+        valid_batches: List of (inputs, labels) batches the validation loss is computed on.
+        input_shape: Shape of a single input without the batch dimension.
+        frames: Number of single frame forward passes timed per network.
+
+    Returns:
+        Dict of the latency summary and summed MSE validation loss of each network, keyed by name.
+    """
+    loss_func = nn.MSELoss()
+    frame = torch.randint(0, 256, (1,) + tuple(input_shape), dtype=torch.uint8)
+    results = {}
+    with torch.inference_mode():
+        for name, model in models.items():
+            latency = helper.LatencyStats()
+            for _ in range(10):
+                model(frame)
+            for _ in range(frames):
+                with latency.time():
+                    model(frame)
+            valid_loss = sum(float(loss_func(model(x), y.view(len(y), -1))) for x, y in valid_batches)
+            results[name] = {"latency": latency.summary(), "valid_loss": valid_loss}
+    return results
+
+
+def quantize_exported(pt_path, calibration_size=2000, directory=None):
+    """ Quantize a network exported with model_export, calibrating it on the training split of the packed dataset.
+
+    Args:
+        pt_path: Path of the exported <name>.pt file.
+        calibration_size: Number of training samples the convolutions are calibrated on.
+        directory: Folder the quantized network is written to, defaults to the models folder.
+
+    Returns:
+        The path of the quantized TorchScript file, and the benchmark results of the float and quantized networks.
+    """
+    name = os.path.basename(pt_path)[:-len('.pt')]
+    input_shape = torch.load(pt_path, map_location='cpu', weights_only=True)['input_shape']
+    # Same split and seed as the training scripts
+    train_loader, valid_loader = get_mario_train_valid_loader(50, False, 123, history=input_shape[0], preload=True)
+    calibration_batches = []
+    for x, _ in train_loader:
+        calibration_batches.append(x)
+        if len(calibration_batches) * len(x) >= calibration_size:
+            break
+
+    ts_path = export(quantize(model_export.load_state_dict_model(pt_path), calibration_batches), name, input_shape,
+                     directory=directory)
+    float_model = model_export.load_state_dict_model(pt_path).eval()
+    models = {"float32": float_model, "int8": model_export.load_inference_model(ts_path)}
+    float_ts_path = os.path.join(os.path.dirname(pt_path), '{}.ts'.format(name))
+    if os.path.exists(float_ts_path):
+        models["float32_ts"] = model_export.load_inference_model(float_ts_path)
+    return ts_path, benchmark(models, list(valid_loader), input_shape)
+
+
+if __name__ == '__main__':
+    """ Quantize the exported networks in the models folder and compare them with their float versions. """
+    logging.basicConfig(level=logging.INFO)
+    models_folder = helper.get_models_folder()
+    for file_name in sorted(os.listdir(models_folder)):
+        if not file_name.endswith('.pt'):
+            continue
+        _, results = quantize_exported(os.path.join(models_folder, file_name))
+        for model_name, result in results.items():
+            logger.info("{} {}: p50 {:.3f} ms, p99 {:.3f} ms, validation loss {:.4f}".format(
+                file_name, model_name, result["latency"]["p50_ms"], result["latency"]["p99_ms"], result["valid_loss"]))
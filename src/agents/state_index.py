@@ -0,0 +1,83 @@
+""" This module implements a compact index of the basic Mario Kart AI agent's states.
+
+States are keyed by a 64 bit digest of the downsampled uint8 frame instead of a tuple of its pixels. The key press
+probabilities of all states live in one contiguous table with one row per state id, so looking up a frame costs one
+hash and one row read.
+"""
+
+import hashlib
+import logging
+
+import numpy as np
+
+from src import keylog
+
+logger = logging.getLogger(__name__)
+
+KEY_NAMES = [key.name for key in keylog.Keyboard]
+
+
+def single_channel(image):
+    """ Return the channel used as the agent state, matching helper.generate_img_key. """
+    return image[:, :, 1] if image.ndim == 3 else image
+
+
+def frame_digest(image):
+    """ Return the 64 bit digest of a downsampled image as an int. """
+    frame = np.ascontiguousarray(single_channel(image), dtype=np.uint8)
+    return int.from_bytes(hashlib.blake2b(frame.tobytes(), digest_size=8).digest(), 'little')
+
+
+class StateIndex:
+    """ Lookup table from downsampled frames to key press probabilities.
+
+    Attributes:
+        digests: uint64 array with the frame digest of each state id.
+        frames: uint8 array with the flattened downsampled frame of each state id.
+        probabilities: float32 array of shape (num_states, len(keylog.Keyboard)) with the key press probabilities of
+            each state id, columns in keylog.Keyboard order.
+        visits: uint32 array with the number of times each state id was seen in training.
+        defaults: float32 array with the key press probabilities used for unseen states.
+    """
+
+    def __init__(self, digests, frames, probabilities, visits, defaults):
+        self.digests = np.asarray(digests, dtype=np.uint64)
+        self.frames = np.asarray(frames, dtype=np.uint8)
+        self.probabilities = np.asarray(probabilities, dtype=np.float32)
+        self.visits = np.asarray(visits, dtype=np.uint32)
+        self.defaults = np.asarray(defaults, dtype=np.float32)
+        self.ids = dict(zip(self.digests.tolist(), range(len(self.digests))))
+
+    def __len__(self):
+        return len(self.digests)
+
+    def state_id(self, image):
+        """ Return the state id of a downsampled image, or None if the state has never been seen. """
+        return self.ids.get(frame_digest(image))
+
+    def lookup(self, image):
+        """ Return the key press probabilities of a downsampled image, falling back to the defaults. """
+        state_id = self.state_id(image)
+        return self.defaults if state_id is None else self.probabilities[state_id]
+
+    def save(self, path):
+        np.savez(path, digests=self.digests, frames=self.frames, probabilities=self.probabilities,
+                 visits=self.visits, defaults=self.defaults, key_names=np.array(KEY_NAMES))
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if list(data['key_names']) != KEY_NAMES:
+                raise ValueError("{} was saved for keys {}, expected {}".format(path, list(data['key_names']),
+                                                                                KEY_NAMES))
+            return cls(data['digests'], data['frames'], data['probabilities'], data['visits'], data['defaults'])
+
+    @classmethod
+    def from_decision_map(cls, decision_map, defaults, state_counts=None):
+        """ Build an index from a StateModel decision map keyed by tuples of pixels. """
+        keys = list(decision_map)
+        frames = np.array(keys, dtype=np.uint8).reshape(len(keys), -1) if keys else np.empty((0, 0), np.uint8)
+        digests = [frame_digest(frame) for frame in frames]
+        probabilities = [[decision_map[key].get(name, 0) for name in KEY_NAMES] for key in keys]
+        visits = [state_counts.get(key, 1) for key in keys] if state_counts else np.ones(len(keys))
+        return cls(digests, frames, probabilities, visits, [defaults.get(name, 0) for name in KEY_NAMES])
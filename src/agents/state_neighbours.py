@@ -0,0 +1,119 @@
+""" This module finds the closest known state of a downsampled frame the basic Mario Kart AI agent has never seen.
+
+Every stored state is quantized to a thermometer code: for each pixel, one bit per quantization threshold it exceeds.
+The Hamming distance between two codes approximates the L1 distance between the frames at the quantization
+resolution, and is computed for many states at once with XOR and popcount over packed bytes.
+
+The codes are indexed with bit sampling locality sensitive hashing: each of several tables keys the states by a random
+subset of their code bits, so states at a small Hamming distance of a frame likely share a key with it in some table.
+A query only computes the distances to the states sharing a key with the frame.
+"""
+
+import logging
+import time
+
+import numpy as np
+
+from src.agents.state_index import single_channel
+
+logger = logging.getLogger(__name__)
+
+# Popcount of every byte value, used when numpy has no bitwise_count
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x):
+    return np.bitwise_count(x) if hasattr(np, 'bitwise_count') else POPCOUNT[x]
+
+
+class NearestStateIndex:
+    """ Approximate nearest neighbour search over the frames of a StateIndex with a bounded query time.
+
+    Attributes:
+        codes: uint8 array with the packed thermometer code of each state id.
+        truncated_queries: Number of queries that ran out of time before probing every table.
+    """
+
+    def __init__(self, state_index, levels=8, time_budget=0.005, tables=16, bits_per_key=24, max_distance=None,
+                 seed=0):
+        """ Create NearestStateIndex instance.
+
+        Args:
+            state_index: StateIndex whose frames are searched.
+            levels: Number of quantization levels of a pixel, i.e. one more than the number of bits per pixel.
+            time_budget: Number of seconds after which a query returns the closest state found so far. The time budget
+                is checked between tables.
+            tables: Number of hash tables. More tables find more of the close states at a higher query cost.
+            bits_per_key: Number of code bits sampled into the key of a table, at most 64. More bits make the buckets
+                smaller and more selective.
+            max_distance: Optional largest Hamming distance for which a neighbour is returned.
+            seed: Seed of the sampled code bits.
+        """
+        self.thresholds = np.arange(1, levels, dtype=np.int32) * 256 // levels
+        self.time_budget = time_budget
+        self.max_distance = max_distance
+        self.truncated_queries = 0
+        if len(state_index) == 0:
+            self.codes = np.empty((0, 0), dtype=np.uint8)
+            self.bits = []
+            self.keys = []
+            self.orders = []
+            return
+        self.codes = self.encode(state_index.frames.reshape(len(state_index), -1))
+
+        # Only bits that differ between states tell them apart
+        varying = np.bitwise_or.reduce(self.codes, axis=0) & ~np.bitwise_and.reduce(self.codes, axis=0)
+        candidates = np.flatnonzero(np.unpackbits(varying))
+        if not len(candidates):
+            candidates = np.arange(self.codes.shape[1] * 8)
+        rng = np.random.default_rng(seed)
+        self.bits = [rng.choice(candidates, min(bits_per_key, len(candidates)), replace=False) for _ in range(tables)]
+        # Each table is the sorted keys of the states and the state ids in that order, looked up with a binary search
+        self.keys = []
+        self.orders = []
+        for bits in self.bits:
+            keys = self._keys(self.codes, bits)
+            order = np.argsort(keys, kind='stable')
+            self.keys.append(keys[order])
+            self.orders.append(order)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def encode(self, frames):
+        """ Return the packed thermometer codes of an array of flattened uint8 frames. """
+        bits = frames[:, :, None] >= self.thresholds
+        return np.packbits(bits.reshape(len(frames), -1), axis=1)
+
+    @staticmethod
+    def _keys(codes, bits):
+        # Bit i of a key is the code bit bits[i], numbered like np.unpackbits
+        sampled = (codes[:, bits >> 3] >> (7 - (bits & 7)).astype(np.uint8)) & 1
+        return (sampled.astype(np.uint64) << np.arange(len(bits), dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+
+    def query(self, image):
+        """ Return the state id closest to a downsampled image and its distance, or (None, None) if no state shares a
+        key with the image or there is no state within max_distance. Tables not probed within the time budget are
+        not considered. """
+        if not len(self.codes):
+            return None, None
+        deadline = time.perf_counter() + self.time_budget
+        code = self.encode(single_channel(image).reshape(1, -1))
+        best_id, best_distance = None, None
+        checked = np.zeros(len(self.codes), dtype=bool)
+        for table, (bits, keys, order) in enumerate(zip(self.bits, self.keys, self.orders)):
+            key = self._keys(code, bits)[0]
+            ids = order[np.searchsorted(keys, key, side='left'):np.searchsorted(keys, key, side='right')]
+            ids = ids[~checked[ids]]
+            if len(ids):
+                checked[ids] = True
+                distances = popcount(self.codes[ids] ^ code).sum(axis=1, dtype=np.int32)
+                i = int(distances.argmin())
+                if best_distance is None or distances[i] < best_distance:
+                    best_id, best_distance = int(ids[i]), int(distances[i])
+            if time.perf_counter() > deadline and table + 1 < len(self.bits):
+                self.truncated_queries += 1
+                break
+        if best_id is None or (self.max_distance is not None and best_distance > self.max_distance):
+            return None, None
+        return best_id, best_distance
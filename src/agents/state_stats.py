@@ -0,0 +1,234 @@
+""" This module stores the basic Mario Kart AI agent's state model as sufficient statistics.
+
+Rather than probabilities, the model keeps how often each state was visited and how often each key was pressed in it.
+Statistics of different sessions merge by adding counts, which is associative and commutative, so sessions can be
+combined in any order and in parallel. The key press probabilities of a StateIndex are derived from the merged counts.
+"""
+
+import logging
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+
+from src.agents.state_index import KEY_NAMES, StateIndex, frame_digest
+
+logger = logging.getLogger(__name__)
+
+
+class StateStats:
+    """ Per-state visit and key press counts.
+
+    Attributes:
+        digests: uint64 array with the frame digest of each state, in ascending order.
+        frames: uint8 array with the flattened downsampled frame of each state.
+        press_counts: uint32 array of shape (num_states, len(keylog.Keyboard)) with the number of times each key was
+            pressed in each state, columns in keylog.Keyboard order.
+        visits: uint32 array with the number of times each state was seen.
+    """
+
+    def __init__(self, digests, frames, press_counts, visits):
+        self.digests = np.asarray(digests, dtype=np.uint64)
+        self.frames = np.asarray(frames, dtype=np.uint8)
+        self.press_counts = np.asarray(press_counts, dtype=np.uint32).reshape(len(self.digests), len(KEY_NAMES))
+        self.visits = np.asarray(visits, dtype=np.uint32)
+        if np.any(self.digests[1:] < self.digests[:-1]):
+            # Keeping the states sorted by digest lets merge() find them with a binary search
+            order = np.argsort(self.digests, kind='stable')
+            self.digests, self.frames = self.digests[order], self.frames[order]
+            self.press_counts, self.visits = self.press_counts[order], self.visits[order]
+
+    def __len__(self):
+        return len(self.digests)
+
+    @classmethod
+    def empty(cls):
+        return cls(np.empty(0), np.empty((0, 0)), np.empty((0, len(KEY_NAMES))), np.empty(0))
+
+    @classmethod
+    def from_frames(cls, frames, presses):
+        """ Count the states of training data in one pass of vectorized reductions.
+
+        Args:
+            frames: Array of shape (n, height, width) or (n, height, width, channels) holding the downsampled frames.
+            presses: Array of shape (n, len(keylog.Keyboard)) holding the 0/1 key press states of each frame.
+        """
+        frames = np.asarray(frames, dtype=np.uint8)
+        if frames.ndim == 4:
+            frames = frames[:, :, :, 1]
+        if len(frames) == 0:
+            return cls.empty()
+        presses = np.asarray(presses, dtype=np.float64).reshape(len(frames), len(KEY_NAMES))
+        states, inverse, visits = np.unique(frames.reshape(len(frames), -1), axis=0, return_inverse=True,
+                                            return_counts=True)
+        inverse = inverse.reshape(-1)
+        press_counts = np.stack([np.bincount(inverse, weights=presses[:, k], minlength=len(states))
+                                 for k in range(len(KEY_NAMES))], axis=1)
+        digests = [frame_digest(state) for state in states]
+        return cls(digests, states, press_counts, visits)
+
+    @classmethod
+    def from_decision_map(cls, decision_map, state_counts):
+        """ Recover counts from a legacy pickled StateModel. Its probabilities are scaled back up by its state counts,
+        which is exact for models trained in a single session. """
+        index = StateIndex.from_decision_map(decision_map, {}, state_counts)
+        press_counts = np.rint(index.probabilities * index.visits[:, None])
+        return cls(index.digests, index.frames, press_counts, index.visits)
+
+    def merge(self, other):
+        """ Return the statistics of both self and other.
+
+        The states of other are found among the sorted digests of self with a binary search, so the lookups cost
+        O(len(other) log len(self)). Building the merged arrays copies both inputs once, so a merge costs
+        O(len(self) + len(other)) overall.
+        """
+        if len(self) == 0:
+            return other
+        if len(other) == 0:
+            return self
+        positions = np.searchsorted(self.digests, other.digests)
+        seen = self.digests[np.minimum(positions, len(self) - 1)] == other.digests
+        press_counts = self.press_counts.copy()
+        visits = self.visits.copy()
+        press_counts[positions[seen]] += other.press_counts[seen]
+        visits[positions[seen]] += other.visits[seen]
+        # Both digest arrays are sorted, so inserting the new states before their search positions keeps them sorted
+        new = ~seen
+        insert_at = positions[new]
+        return StateStats(np.insert(self.digests, insert_at, other.digests[new]),
+                          np.insert(self.frames, insert_at, other.frames[new], axis=0),
+                          np.insert(press_counts, insert_at, other.press_counts[new], axis=0),
+                          np.insert(visits, insert_at, other.visits[new]))
+
+    @staticmethod
+    def merge_all(stats, processes=None):
+        """ Merge a list of statistics as a tree of pairwise merges, each level run in a process pool.
+
+        Args:
+            stats: List of StateStats.
+            processes: Number of worker processes, defaults to the number of CPUs. Use 1 to merge in this process.
+        """
+        stats = list(stats)
+        if not stats:
+            return StateStats.empty()
+        pool = multiprocessing.Pool(processes) if processes != 1 and len(stats) > 2 else None
+        try:
+            while len(stats) > 1:
+                pairs = list(zip(stats[0::2], stats[1::2]))
+                merged = pool.starmap(StateStats.merge, pairs) if pool else [a.merge(b) for a, b in pairs]
+                stats = merged + stats[2 * len(pairs):]
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+        return stats[0]
+
+    def to_index(self):
+        """ Return the StateIndex with the key press probabilities of these statistics. """
+        visits = self.visits.astype(np.float64)
+        probabilities = self.press_counts / np.maximum(visits, 1)[:, None]
+        # Laplace smoothing for default actions
+        defaults = (self.press_counts.sum(axis=0, dtype=np.float64) + 1) / (visits.sum() + 2)
+        return StateIndex(self.digests, self.frames, probabilities, self.visits, defaults)
+
+    def save(self, path, **metadata):
+        np.savez(path, digests=self.digests, frames=self.frames, press_counts=self.press_counts, visits=self.visits,
+                 key_names=np.array(KEY_NAMES), **metadata)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            if list(data['key_names']) != KEY_NAMES:
+                raise ValueError("{} was saved for keys {}, expected {}".format(path, list(data['key_names']),
+                                                                                KEY_NAMES))
+            return cls(data['digests'], data['frames'], data['press_counts'], data['visits'])
+
+
+class StateStatsStore:
+    """ On-disk state model made of one StateStats segment file per training session.
+
+    The store folder holds:
+        <number>.npz: The statistics of one session, numbered in the order they were added. append() only writes the
+            new segment, so adding a session costs O(size of the session) regardless of the size of the model.
+        base.npz: The statistics of all sessions up to the segment number it records, written by compact(), which
+            folds the segments into it and deletes them. Compacting costs O(size of the model).
+    load() merges base.npz with the segments added since, so it costs O(size of the model) as well. base.npz is written
+    under a temporary name and swapped in before the segments it holds are deleted, and segments at or below its
+    recorded number are ignored, so an interrupted compact() never counts a session twice.
+    """
+
+    BASE_FILE = 'base.npz'
+
+    def __init__(self, path, legacy_model=None):
+        """ Open a store, creating its folder if needed.
+
+        Args:
+            path: Folder holding the segment files.
+            legacy_model: Optional pickled StateModel imported as the first segment of a new store.
+        """
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        if legacy_model and not self.segments() and self._base_segment() < 0 and os.path.exists(legacy_model):
+            with open(legacy_model, 'rb') as mf:
+                pfile = pickle.load(mf)
+            self.append(StateStats.from_decision_map(pfile.get('model'), pfile.get('state_counts')))
+            logger.info("Imported legacy model {} into {}".format(legacy_model, path))
+
+    def segments(self):
+        return sorted(os.path.join(self.path, name) for name in os.listdir(self.path)
+                      if name.endswith('.npz') and name[:-len('.npz')].isdigit())
+
+    @staticmethod
+    def _number(segment):
+        return int(os.path.basename(segment)[:-len('.npz')])
+
+    def _base_segment(self):
+        # The last segment number held by base.npz, -1 if there is no base yet
+        path = os.path.join(self.path, self.BASE_FILE)
+        if not os.path.exists(path):
+            return -1
+        with np.load(path) as data:
+            return int(data['last_segment'])
+
+    def _load_base(self):
+        base_segment = self._base_segment()
+        if base_segment < 0:
+            return StateStats.empty(), base_segment
+        return StateStats.load(os.path.join(self.path, self.BASE_FILE)), base_segment
+
+    def append(self, stats):
+        """ Write the statistics of a new session as the next segment. """
+        segments = self.segments()
+        number = max(self._number(segments[-1]) if segments else -1, self._base_segment()) + 1
+        path = os.path.join(self.path, "{:06d}.npz".format(number))
+        # Write to a temporary file first so that readers never see a partial segment
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            stats.save(f)
+        os.replace(tmp_path, path)
+
+    def _pending(self, base_segment):
+        return [path for path in self.segments() if self._number(path) > base_segment]
+
+    def load(self, processes=1):
+        """ Return the merged statistics of all sessions without writing to the store. """
+        base, base_segment = self._load_base()
+        return StateStats.merge_all([base] + [StateStats.load(path) for path in self._pending(base_segment)],
+                                    processes=processes)
+
+    def compact(self, processes=1):
+        """ Fold the segments added since the last compaction into base.npz, then delete them. """
+        base, base_segment = self._load_base()
+        segments = self._pending(base_segment)
+        if segments:
+            stats = StateStats.merge_all([base] + [StateStats.load(path) for path in segments], processes=processes)
+            base_segment = self._number(segments[-1])
+            path = os.path.join(self.path, self.BASE_FILE)
+            with open(path + '.tmp', 'wb') as f:
+                stats.save(f, last_segment=base_segment)
+            os.replace(path + '.tmp', path)
+        # Segments left behind by an interrupted compaction are already part of base.npz
+        for path in self.segments():
+            if self._number(path) <= base_segment:
+                os.unlink(path)
@@ -0,0 +1,235 @@
+""" This module runs hyperparameter sweeps over the Mario Kart neural networks.
+
+A sweep is a list of runs. Each run trains one network class with one set of hyperparameters through
+training.train(). The runs are trained concurrently in a pool of worker processes:
+    1) The parent preloads the packed dataset once for every distinct history length, batch size and seed in the
+        sweep into shared memory tensors, see train_valid_data.TensorBatchLoader. The workers receive the loaders
+        when they start and train every run from them, without loading or copying the dataset.
+    2) Every worker uses threads_per_run torch threads and the pool has as many workers as fit on the cores. The runs
+        are queued from the most expensive down, so that no long run starts last and leaves the other cores idle.
+    3) The parent records each run in a SQLite results table as it starts and finishes, see results().
+Runs are named after their sweep and a digest of their network and settings, see run_name(), and checkpoint under
+that name. A sweep started again skips the runs its results table marks as finished and resumes the others where they
+left off, even if runs were added to or removed from it in between.
+"""
+
+import concurrent.futures
+import hashlib
+import inspect
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import time
+
+import torch
+import torch.multiprocessing as mp
+
+from src import helper
+from src.agents import model_export, training
+from src.agents.train_valid_data import get_mario_train_valid_loader
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    sweep TEXT NOT NULL,
+    name TEXT NOT NULL,
+    model TEXT NOT NULL,
+    hyperparameters TEXT NOT NULL,
+    config TEXT NOT NULL,
+    status TEXT NOT NULL,
+    best_valid_loss REAL,
+    final_valid_loss REAL,
+    seconds REAL,
+    error TEXT,
+    PRIMARY KEY (sweep, name)
+)
+"""
+
+# Networks that can be swept, by the class names they are known by
+SWEEP_MODELS = ('MKNN', 'MKCNN', 'MKCRNN_gru', 'MKCRNN_lstm', 'MKRNN_lstm')
+
+
+def get_results_path():
+    return os.path.join(helper.get_models_folder(), "sweeps.sqlite")
+
+
+def grid(model, **options):
+    """ Return the runs of every combination of hyperparameter values.
+
+    Args:
+        model: Name of the network class, one of SWEEP_MODELS.
+        options: Lists of values keyed by the network constructor arguments, e.g. num_input_frames, or by the
+            training.TrainingConfig arguments, e.g. learning_rate. Single values are used for every run.
+
+    Returns:
+        List of (model, hyperparameters, config) runs, the latter two dicts of network and training arguments.
+    """
+    if model not in SWEEP_MODELS:
+        raise ValueError("Unknown model {}, expected one of {}.".format(model, ", ".join(SWEEP_MODELS)))
+    model_arguments = inspect.signature(model_export.import_class(model_export.MODEL_CLASSES[model])).parameters
+    config_arguments = inspect.signature(training.TrainingConfig).parameters
+    for key in options:
+        if (key not in model_arguments and key not in config_arguments) or key == 'name':
+            raise ValueError("{} is neither a hyperparameter of {} nor a training setting.".format(key, model))
+    keys = list(options)
+    values = [value if isinstance(value, (list, tuple)) else [value] for value in options.values()]
+    runs = []
+    for combination in itertools.product(*values):
+        hyperparameters = {key: value for key, value in zip(keys, combination) if key in model_arguments}
+        config = {key: value for key, value in zip(keys, combination) if key not in model_arguments}
+        runs.append((model, hyperparameters, config))
+    return runs
+
+
+def run_name(sweep, model, hyperparameters, config):
+    """ Return the name of a run, <sweep>_<digest of its network, hyperparameters and training settings>. """
+    key = json.dumps([model, hyperparameters, config], sort_keys=True)
+    return "{}_{}".format(sweep, hashlib.sha1(key.encode()).hexdigest()[:12])
+
+
+def _cost(model_class, hyperparameters, config):
+    # Training time grows with the epochs and, roughly, the size of the network
+    model = model_class(**hyperparameters)
+    return config.get('num_epochs', 50) * sum(p.numel() for p in model.parameters()) * model.input_shape[0]
+
+
+_worker_loaders = {}
+
+
+def _loader_key(history, config):
+    return history, config.get('batch_size', 50), config.get('seed', 123)
+
+
+def _init_worker(loaders, threads_per_run):
+    _worker_loaders.update(loaders)
+    torch.set_num_threads(threads_per_run)
+
+
+def _train_run(name, model, hyperparameters, config, export):
+    start = time.perf_counter()
+    model_class = model_export.import_class(model_export.MODEL_CLASSES[model])
+    history = model_class(**hyperparameters).input_shape[0]
+    network, losses = training.train(model_class, training.TrainingConfig(name, **config), hyperparameters,
+                                     loaders=_worker_loaders[_loader_key(history, config)])
+    if export:
+        model_export.export(network, name, network.input_shape, onnx=False)
+    return losses, time.perf_counter() - start
+
+
+class Sweep:
+    """ Class training the runs of a sweep in a process pool and recording them in a results table. """
+
+    def __init__(self, name, runs, threads_per_run=1, workers=None, results_path=None, export=False):
+        """ Create Sweep instance.
+
+        Args:
+            name: Name of the sweep, prefixed to the names of its runs.
+            runs: List of (model, hyperparameters, config) runs, e.g. from grid().
+            threads_per_run: Number of torch threads each run trains with.
+            workers: Number of runs trained at once. Defaults to the number of cores divided by threads_per_run.
+            results_path: SQLite database the results are written to. Defaults to models/sweeps.sqlite.
+            export: Whether to export the network of each run with model_export.
+        """
+        self.name = name
+        self.runs = runs
+        self.threads_per_run = threads_per_run
+        self.workers = workers or max(1, os.cpu_count() // threads_per_run)
+        self.results_path = results_path or get_results_path()
+        self.export = export
+
+    def run(self):
+        """ Train the runs of the sweep that have not finished yet and return the results of all its runs, see
+        results(). """
+        database = sqlite3.connect(self.results_path)
+        database.execute(SCHEMA)
+        finished = {name for name, in database.execute("SELECT name FROM runs WHERE sweep = ? AND status = 'finished'",
+                                                        (self.name,))}
+        runs = {}
+        for model, hyperparameters, config in self.runs:
+            name = run_name(self.name, model, hyperparameters, config)
+            if name in finished:
+                logger.info("Run {} already finished, skipping it.".format(name))
+            else:
+                runs[name] = (model, hyperparameters, config)
+        costs = {name: _cost(model_export.import_class(model_export.MODEL_CLASSES[model]), hyperparameters, config)
+                 for name, (model, hyperparameters, config) in runs.items()}
+        order = sorted(runs, key=lambda name: costs[name], reverse=True)
+
+        if order:
+            context = mp.get_context('spawn')
+            with database, concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=context,
+                                                                  initializer=_init_worker,
+                                                                  initargs=(self._load(runs.values()),
+                                                                            self.threads_per_run)) as pool:
+                futures = {}
+                for name in order:
+                    model, hyperparameters, config = runs[name]
+                    database.execute("INSERT OR REPLACE INTO runs (sweep, name, model, hyperparameters, config, "
+                                     "status) VALUES (?, ?, ?, ?, ?, 'queued')",
+                                     (self.name, name, model, json.dumps(hyperparameters), json.dumps(config)))
+                    futures[pool.submit(_train_run, name, model, hyperparameters, config, self.export)] = name
+                database.commit()
+                for future in concurrent.futures.as_completed(futures):
+                    self._record(database, futures[future], future)
+        database.close()
+        return results(self.results_path, self.name)
+
+    def _load(self, runs):
+        # One preloaded loader pair per history length, batch size and seed, shared by all runs using it
+        loaders = {}
+        for model, hyperparameters, config in runs:
+            model_class = model_export.import_class(model_export.MODEL_CLASSES[model])
+            key = _loader_key(model_class(**hyperparameters).input_shape[0], config)
+            if key not in loaders:
+                history, batch_size, seed = key
+                loaders[key] = get_mario_train_valid_loader(batch_size, False, seed, history=history, preload=True)
+        return loaders
+
+    def _record(self, database, name, future):
+        try:
+            losses, seconds = future.result()
+        except Exception as e:
+            logger.error("Run {} failed: {}".format(name, e))
+            database.execute("UPDATE runs SET status = 'failed', error = ? WHERE sweep = ? AND name = ?",
+                             (repr(e), self.name, name))
+        else:
+            logger.info("Run {} finished in {:.1f} s.".format(name, seconds))
+            database.execute("UPDATE runs SET status = 'finished', best_valid_loss = ?, final_valid_loss = ?, "
+                             "seconds = ? WHERE sweep = ? AND name = ?",
+                             (min(losses) if losses else None, losses[-1] if losses else None, seconds, self.name,
+                              name))
+        database.commit()
+
+
+def results(results_path=None, sweep=None):
+    """ Return the recorded runs as dicts, best validation loss first.
+
+    Args:
+        results_path: SQLite database of the results. Defaults to models/sweeps.sqlite.
+        sweep: Name of the sweep to return the runs of. Defaults to all sweeps.
+    """
+    database = sqlite3.connect(results_path or get_results_path())
+    database.row_factory = sqlite3.Row
+    query = "SELECT * FROM runs{} ORDER BY best_valid_loss IS NULL, best_valid_loss".format(
+        " WHERE sweep = ?" if sweep else "")
+    rows = [dict(row) for row in database.execute(query, (sweep,) if sweep else ())]
+    database.close()
+    for row in rows:
+        row['hyperparameters'] = json.loads(row['hyperparameters'])
+        row['config'] = json.loads(row['config'])
+    return rows
+
+
+if __name__ == '__main__':
+    """ Compare the input frame counts and history lengths of the convolutional and recurrent networks. """
+    logging.basicConfig(level=logging.INFO)
+    runs = grid('MKCNN', num_input_frames=[1, 2, 3]) + \
+        grid('MKCRNN_gru', history=[2, 3]) + \
+        grid('MKCRNN_lstm', history=[2, 3]) + \
+        grid('MKRNN_lstm', history=[2, 3, 5])
+    for row in Sweep('frames', runs, export=True).run():
+        logger.info("{} {} {}: best validation loss {}".format(row['name'], row['model'], row['hyperparameters'],
+                                                               row['best_valid_loss']))
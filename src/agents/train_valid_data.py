@@ -1,9 +1,11 @@
+import copy
+
 import numpy as np
 import torch
 from torch.utils.data.sampler import SubsetRandomSampler
 from torchvision import transforms
 
-from src.agents.mk_dataset import MarioKartDataset
+from src.agents.mk_dataset import MarioKartDataset, WindowBatchSampler, WindowedMarioKartDataset
 
 
 def get_mario_train_valid_loader(batch_size,
@@ -13,7 +15,9 @@ def get_mario_train_valid_loader(batch_size,
                                  shuffle=True,
                                  history=1,
                                  num_workers=1,
-                                 pin_memory=False):
+                                 pin_memory=False,
+                                 windowed=False,
+                                 preload=False):
     """
     Utility function for loading and returning train and valid
     multi-process iterators over the MarioKart dataset. A sample
@@ -33,6 +37,13 @@ def get_mario_train_valid_loader(batch_size,
     - num_workers: number of subprocesses to use when loading the dataset.
     - pin_memory: whether to copy tensors into CUDA pinned memory. Set it to
       True if using GPU.
+    - windowed: whether to preload the packed dataset into a single tensor and
+      gather each batch of history windows with one index operation. No worker
+      processes are used in this mode and augment is not supported.
+    - preload: whether to gather the history windows of all samples into one
+      tensor in shared memory up front. The train and valid splits are views of
+      it and each batch is sampled with a single index operation. Takes
+      precedence over windowed. augment is not supported either.
     Returns
     -------
     - train_loader: training set iterator.
@@ -61,6 +72,14 @@ def get_mario_train_valid_loader(batch_size,
             normalize
         ])
 
+    if (preload or windowed) and augment:
+        # The windows are gathered as uint8 tensors straight from the packed frames, the image transforms don't apply
+        raise ValueError("augment is not supported by the windowed and preloaded loaders.")
+    if preload:
+        return _get_preloaded_train_valid_loader(batch_size, random_seed, valid_size, shuffle, history, pin_memory)
+    if windowed:
+        return _get_windowed_train_valid_loader(batch_size, random_seed, valid_size, shuffle, history, pin_memory)
+
     # load the dataset
     train_dataset = MarioKartDataset(transform=train_transform, history=history)
     valid_dataset = MarioKartDataset(transform=valid_transform, history=history)
@@ -86,3 +105,118 @@ def get_mario_train_valid_loader(batch_size,
                                                batch_size=batch_size, sampler=valid_sampler,
                                                num_workers=num_workers, pin_memory=pin_memory)
     return train_loader, valid_loader
+
+
+def _get_windowed_train_valid_loader(batch_size, random_seed, valid_size, shuffle, history, pin_memory):
+    dataset = WindowedMarioKartDataset(history=history)
+
+    num_train = len(dataset)
+    indices = list(range(num_train))
+    split = int(np.floor(valid_size * num_train))
+
+    if shuffle:
+        np.random.seed(random_seed)
+        np.random.shuffle(indices)
+
+    train_idx, valid_idx = indices[split:], indices[:split]
+
+    train_sampler = WindowBatchSampler(train_idx, batch_size)
+    valid_sampler = WindowBatchSampler(valid_idx, batch_size)
+
+    # batch_size=None hands every batch of indices from the sampler to the dataset in one call
+    train_loader = torch.utils.data.DataLoader(dataset, batch_size=None, sampler=train_sampler,
+                                               pin_memory=pin_memory)
+
+    valid_loader = torch.utils.data.DataLoader(dataset, batch_size=None, sampler=valid_sampler,
+                                               pin_memory=pin_memory)
+    return train_loader, valid_loader
+
+
+def _get_preloaded_train_valid_loader(batch_size, random_seed, valid_size, shuffle, history, pin_memory):
+    dataset = WindowedMarioKartDataset(history=history)
+
+    num_train = len(dataset)
+    indices = np.arange(num_train)
+    split = int(np.floor(valid_size * num_train))
+
+    if shuffle:
+        np.random.seed(random_seed)
+        np.random.shuffle(indices)
+
+    # Gather the samples in split order once, so that both splits are contiguous views of the same tensors
+    order = torch.from_numpy(indices)
+    inputs, labels = dataset[order]
+    inputs.share_memory_()
+    labels.share_memory_()
+
+    train_loader = TensorBatchLoader(inputs[split:], labels[split:], batch_size, pin_memory=pin_memory,
+                                     seed=random_seed)
+    valid_loader = TensorBatchLoader(inputs[:split], labels[:split], batch_size, pin_memory=pin_memory)
+    return train_loader, valid_loader
+
+
+class TensorBatchLoader:
+    """ Iterates over batches of preloaded input and label tensors, drawing each batch with a single index operation.
+
+    The tensors may live in shared memory, loaders created from them can be passed to other processes without copying
+    the dataset. For data-parallel training, every process iterates over a shard of the loader, see shard().
+    """
+
+    def __init__(self, inputs, labels, batch_size, shuffle=True, pin_memory=False, seed=None):
+        """
+        Args:
+            inputs: tensor of samples, indexed along the first dimension.
+            labels: tensor of labels matching inputs.
+            batch_size: how many samples per batch to load.
+            shuffle: whether to visit the samples in a new random order every epoch.
+            pin_memory: whether to copy each batch into CUDA pinned memory.
+            seed: seed of the sample order. Given a seed, the order only depends on the seed and the epoch set with
+                set_epoch, so that shards agree on it and resumed training continues with the same batches.
+        """
+        self.inputs = inputs
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pin_memory = pin_memory
+        self.seed = seed
+        self.epoch = 0
+        self.rank = 0
+        self.world_size = 1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batch_length(self, index):
+        """ Return the number of samples of the index-th batch before sharding. """
+        return max(0, min(self.batch_size, len(self.inputs) - index * self.batch_size))
+
+    def shard(self, rank, world_size):
+        """ Return a loader yielding the rank-th of world_size interleaved parts of every batch. Requires a seed.
+
+        The parts of a batch differ in size by up to one sample, and are empty for ranks at or above the batch length.
+        """
+        if self.shuffle and self.seed is None:
+            raise ValueError("Shards of a shuffled loader need a seed to agree on the sample order.")
+        shard = copy.copy(self)
+        shard.rank, shard.world_size = rank, world_size
+        return shard
+
+    def __iter__(self):
+        num_samples = len(self.inputs)
+        order = None
+        if self.shuffle and self.seed is None:
+            order = torch.randperm(num_samples)
+        elif self.shuffle:
+            order = torch.randperm(num_samples, generator=torch.Generator().manual_seed(self.seed + self.epoch))
+        for start in range(0, num_samples, self.batch_size):
+            if order is None:
+                batch = slice(start + self.rank, start + self.batch_size, self.world_size)
+            else:
+                batch = order[start:start + self.batch_size][self.rank::self.world_size]
+            x, y = self.inputs[batch], self.labels[batch]
+            if self.pin_memory:
+                x, y = x.pin_memory(), y.pin_memory()
+            yield x, y
+
+    def __len__(self):
+        return (len(self.inputs) + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,224 @@
+""" This module implements the training loop shared by the Mario Kart neural network training scripts.
+
+train() fits any of the training module networks to the preloaded packed dataset with Adam and a mean squared error
+loss. On top of the plain loop it supports:
+    1) bfloat16 autocast of the forward passes on the CPU.
+    2) Checkpoints of the network, optimizer and validation losses every few steps, from which an interrupted run
+        resumes at the step after the checkpoint. A checkpoint records the network class, its hyperparameters and
+        the training settings, and a run only resumes from an unfinished checkpoint with the same ones.
+    3) Data-parallel training across local CPU processes with torch.distributed and the gloo backend. Every process
+        computes the gradients of an interleaved part of each batch from the shared memory dataset. The parts differ
+        by up to one sample, so each process weights its loss by the size of its part before
+        DistributedDataParallel averages the gradients, which then match those of the whole batch. A run takes the
+        same optimizer steps as a single process would, except that a final batch with fewer samples than processes
+        is skipped.
+"""
+
+import logging
+import os
+import socket
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+import torch.nn as nn
+from torch.nn.parallel import DistributedDataParallel
+
+from src import helper
+from src.agents import evaluation
+from src.agents.train_valid_data import get_mario_train_valid_loader
+
+logger = logging.getLogger(__name__)
+
+# Settings a run must share with a checkpoint to resume from it, the others don't change the trained weights
+RESUME_SETTINGS = ('batch_size', 'learning_rate', 'l2_reg', 'bf16', 'world_size', 'seed')
+
+
+class TrainingConfig:
+    """ Settings of a training run. """
+
+    def __init__(self, name, num_epochs=50, batch_size=50, learning_rate=1e-5, l2_reg=0.05, valid_every=50,
+                 async_validation=False, bf16=False, checkpoint_every=500, resume=True, world_size=1, seed=123):
+        """ Create TrainingConfig instance.
+
+        Args:
+            name: Name of the run, used for its checkpoint file.
+            num_epochs: Number of passes over the training split.
+            batch_size: Number of samples per optimizer step, split across the processes.
+            learning_rate: Adam learning rate.
+            l2_reg: Adam weight decay.
+            valid_every: Number of steps between validation passes, see evaluation.Evaluator.
+            async_validation: Whether to run the validation passes in a background process.
+            bf16: Whether to run the forward passes under bfloat16 autocast.
+            checkpoint_every: Number of steps between checkpoints, 0 to only save one at the end.
+            resume: Whether to continue from the checkpoint of an unfinished previous run of the same name, network and
+                settings. Otherwise, or if the checkpoint does not match, the run starts over.
+            world_size: Number of data-parallel processes.
+            seed: Seed of the train/valid split, the sample order and the initial weights.
+        """
+        self.name = name
+        self.num_epochs = num_epochs
+        self.batch_size = batch_size
+        self.learning_rate = learning_rate
+        self.l2_reg = l2_reg
+        self.valid_every = valid_every
+        self.async_validation = async_validation
+        self.bf16 = bf16
+        self.checkpoint_every = checkpoint_every
+        self.resume = resume
+        self.world_size = world_size
+        self.seed = seed
+
+
+def get_checkpoint_folder():
+    file_path = os.path.join(helper.get_models_folder(), "checkpoints")
+    os.makedirs(file_path, exist_ok=True)
+    return file_path
+
+
+def get_checkpoint_path(name):
+    return os.path.join(get_checkpoint_folder(), "{}.ckpt".format(name))
+
+
+def train(model_class, config, model_kwargs=None, loaders=None):
+    """ Train a network.
+
+    Args:
+        model_class: Training module network class, e.g. mk_cnn_train.MKCNN.
+        config: TrainingConfig of the run.
+        model_kwargs: Hyper parameters passed to the network class.
+        loaders: Preloaded train and valid TensorBatchLoader pair. Loaded from the packed dataset if not given.
+
+    Returns:
+        The trained network and the list of its validation losses.
+    """
+    model_kwargs = model_kwargs or {}
+    torch.manual_seed(config.seed)
+    model = model_class(**model_kwargs)
+    if loaders is None:
+        loaders = get_mario_train_valid_loader(config.batch_size, False, config.seed, history=model.input_shape[0],
+                                               preload=True)
+    if config.world_size == 1:
+        return _train(model, config, *loaders)
+
+    # The processes start from the shared memory dataset, the trained network is read back from the final checkpoint
+    mp.spawn(_train_worker, args=(model_class, model_kwargs, config, loaders, _free_port()), nprocs=config.world_size)
+    checkpoint = torch.load(get_checkpoint_path(config.name), map_location='cpu', weights_only=True)
+    model.load_state_dict(checkpoint['model'])
+    return model, checkpoint['validation_losses']
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _train_worker(rank, model_class, model_kwargs, config, loaders, port):
+    torch.set_num_threads(max(1, os.cpu_count() // config.world_size))
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank,
+                            world_size=config.world_size)
+    try:
+        torch.manual_seed(config.seed)
+        _train(model_class(**model_kwargs), config, *loaders, rank=rank)
+    finally:
+        dist.destroy_process_group()
+
+
+def _settings(model, config):
+    # What a checkpoint has to match to be resumed from, see RESUME_SETTINGS
+    return {'model': type(model).__name__, 'hyperparameters': dict(getattr(model, 'hyperparameters', {})),
+            'config': {key: getattr(config, key) for key in RESUME_SETTINGS}}
+
+
+def _save_checkpoint(path, model, optimizer, epoch, step, validation_losses, settings, finished=False):
+    # Written next to the previous checkpoint and swapped in, so that an interruption never leaves a partial file
+    torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 'epoch': epoch, 'step': step,
+                'validation_losses': list(validation_losses), 'rng_state': torch.get_rng_state(),
+                'settings': settings, 'finished': finished}, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _load_checkpoint(path, settings, name):
+    """ Return the checkpoint of a run to resume, or None if there is none or it doesn't match the run. """
+    if not os.path.exists(path):
+        return None
+    checkpoint = torch.load(path, map_location='cpu', weights_only=True)
+    if checkpoint.get('settings') != settings:
+        logger.warning("Checkpoint of {} was saved with different settings, {} instead of {}. Starting over.".format(
+            name, checkpoint.get('settings'), settings))
+        return None
+    if checkpoint.get('finished'):
+        logger.info("{} already finished training, starting over.".format(name))
+        return None
+    return checkpoint
+
+
+def _train(model, config, train_loader, valid_loader, rank=0):
+    distributed = config.world_size > 1
+    optimizer = torch.optim.Adam(model.parameters(), weight_decay=config.l2_reg, lr=config.learning_rate)
+    loss_func = nn.MSELoss()
+    path = get_checkpoint_path(config.name)
+    settings = _settings(model, config)
+
+    start_epoch, start_step, validation_losses = 0, 0, []
+    checkpoint = _load_checkpoint(path, settings, config.name) if config.resume else None
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        start_epoch, start_step, validation_losses = checkpoint['epoch'], checkpoint['step'], \
+            checkpoint['validation_losses']
+        logger.info("Resuming {} at epoch {} step {}.".format(config.name, start_epoch, start_step))
+
+    network = model
+    if distributed:
+        network = DistributedDataParallel(model)
+        train_loader = train_loader.shard(rank, config.world_size)
+    evaluator = None
+    if rank == 0:
+        evaluator = evaluation.Evaluator(model, valid_loader, loss_func, every=config.valid_every,
+                                         asynchronous=config.async_validation)
+        evaluator.losses.extend(validation_losses)
+        evaluator.labels.extend([None] * len(validation_losses))
+
+    if start_epoch or start_step:
+        # Continues the dropout masks where the interrupted run left off
+        torch.set_rng_state(checkpoint['rng_state'])
+    model.train()
+    steps = 0
+    for epoch in range(start_epoch, config.num_epochs):
+        train_loader.set_epoch(epoch)
+        for step, (x, y) in enumerate(train_loader):
+            if epoch == start_epoch and step < start_step:
+                continue
+            batch_length = train_loader.batch_length(step)
+            if distributed and batch_length < config.world_size:
+                # Some process would get no samples
+                continue
+            with torch.autocast('cpu', dtype=torch.bfloat16, enabled=config.bf16):
+                forward_pass = network(x)
+            loss = loss_func(forward_pass.float(), y.view(len(y), -1).float())
+            optimizer.zero_grad()
+            if distributed:
+                # DistributedDataParallel averages over the processes, weighting by part size makes it a sample mean
+                (loss * (len(x) * config.world_size / batch_length)).backward()
+            else:
+                loss.backward()
+            optimizer.step()
+            steps += 1
+
+            if evaluator is not None and evaluator.due(step):
+                valid_loss = evaluator.evaluate((epoch, step))
+                message = "Epoch {} step {}: training loss {:.4f}".format(epoch, step, loss.item())
+                if valid_loss is not None:
+                    message += ", validation loss {:.4f}".format(valid_loss)
+                logger.info(message)
+            if evaluator is not None and config.checkpoint_every and steps % config.checkpoint_every == 0:
+                evaluator.poll()
+                _save_checkpoint(path, model, optimizer, epoch, step + 1, evaluator.losses, settings)
+
+    if evaluator is None:
+        return model, []
+    evaluator.close()
+    _save_checkpoint(path, model, optimizer, config.num_epochs, 0, evaluator.losses, settings, finished=True)
+    return model, evaluator.losses
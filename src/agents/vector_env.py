@@ -0,0 +1,191 @@
+""" This module runs several independent Dolphin instances as one vectorized Mario Kart environment.
+
+Every instance has its own Dolphin user directory, set with dolphin-emu -u <user_dir>, and with it its own fifo pipe at
+<user_dir>/Pipes/pipe and screenshot folder at <user_dir>/ScreenShots/<game_name>. VectorEnv steps all instances
+together and returns their downsampled frames stacked into a single array, so that BatchedNNPolicy can decide on the
+input of every instance with one forward pass of a neural network.
+
+Note:
+    Dolphin hot-keys reach the focused window only, so screenshot frame sources only work for a single instance. Run
+    several instances with shared memory frame sources, e.g. the ones fed by dp_fake_emulator.FakeEmulator.
+"""
+
+import concurrent.futures
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from src import dp_frame_source, helper, key2pad, label_store, mk_downsampler
+
+logger = logging.getLogger(__name__)
+
+
+class EnvInstance:
+    """ A single Dolphin instance of a VectorEnv.
+
+    Attributes:
+        user_dir: Dolphin user directory of the instance.
+        pipe_path: Location of the instance's fifo pipe.
+        frame_source: dp_frame_source.FrameSource of the instance's frames.
+        key_map: key2pad.KeyPadMap sending the instance's input, opened by VectorEnv.reset().
+    """
+
+    def __init__(self, user_dir, game_name="NABE01", frame_source=None):
+        """ Create EnvInstance instance.
+
+        Args:
+            user_dir: Dolphin user directory of the instance.
+            game_name: Game ID used by Dolphin to name the screenshot folder and files.
+            frame_source: dp_frame_source.FrameSource of the instance. Defaults to the screenshots of the user
+                directory.
+        """
+        self.user_dir = os.path.expanduser(user_dir)
+        self.pipe_path = os.path.join(self.user_dir, 'Pipes', 'pipe')
+        if frame_source is None:
+            screenshot_dir = os.path.join(self.user_dir, 'ScreenShots', game_name)
+            frame_source = dp_frame_source.ScreenshotFrameSource(game_name, screenshot_dir=screenshot_dir)
+        self.frame_source = frame_source
+        self.downsampler = mk_downsampler.Downsampler(game_name, final_dim=15)
+        self.key_map = None
+
+
+class VectorEnv:
+    """ Class stepping several Dolphin instances together.
+
+    Attributes:
+        observations: uint8 array of shape (num_envs, 15, 15) with the latest downsampled frame of each instance.
+        captured: bool array telling which instances captured a new frame in the last step. Instances that did not keep
+            their previous observation.
+        stats: Dict of helper.LatencyStats of sending the input to and capturing the frames of all instances.
+    """
+
+    def __init__(self, instances):
+        """ Create VectorEnv instance.
+
+        Args:
+            instances: List of EnvInstance.
+        """
+        self.instances = instances
+        self.num_envs = len(instances)
+        self.observations = np.zeros((self.num_envs, 15, 15), dtype=np.uint8)
+        self.captured = np.zeros(self.num_envs, dtype=bool)
+        self.missed = 0
+        # Waiting for frames overlaps across instances, and OpenCV releases the GIL while downsampling
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.num_envs)
+        self.stats = {stage: helper.LatencyStats() for stage in ('input', 'capture')}
+
+    def reset(self):
+        """ Open the controllers of all instances, release all of their input and capture their first frames.
+
+        Returns:
+            The observations array.
+        """
+        for instance in self.instances:
+            if instance.key_map is None:
+                instance.key_map = key2pad.KeyPadMap(pipe_path=instance.pipe_path)
+            instance.key_map.key_bits = 0
+            instance.key_map.p.reset()
+        self._capture()
+        return self.observations
+
+    def step(self, key_bits):
+        """ Send one frame of input to every instance and capture their next frames.
+
+        Args:
+            key_bits: Sequence with the key bit field of each instance, see key2pad.
+
+        Returns:
+            The observations array, overwritten by the next step.
+        """
+        with self.stats['input'].time():
+            for instance, bits in zip(self.instances, key_bits):
+                instance.key_map.update_bits(int(bits))
+        with self.stats['capture'].time():
+            self._capture()
+        return self.observations
+
+    def close(self):
+        self.executor.shutdown()
+        for instance in self.instances:
+            instance.frame_source.close()
+            if instance.key_map is not None:
+                instance.key_map.p.__exit__()
+
+    def _capture(self):
+        for _ in self.executor.map(self._capture_instance, range(self.num_envs)):
+            pass
+        self.missed += int(self.num_envs - self.captured.sum())
+
+    def _capture_instance(self, i):
+        instance = self.instances[i]
+        frame = instance.frame_source.next_frame()
+        self.captured[i] = frame is not None
+        if frame is not None:
+            instance.downsampler.downsample_image(frame, out=self.observations[i])
+
+
+class BatchedNNPolicy:
+    """ Class choosing the input of all instances of a VectorEnv with a single neural network forward pass. """
+
+    def __init__(self, model, num_envs, history_length=1):
+        """ Create BatchedNNPolicy instance.
+
+        Args:
+            model: Trained Mario Kart neural network, e.g. mk_cnn_train.MKCNN.
+            num_envs: Number of instances.
+            history_length: Number of frames the network sees at once, newest first. The history starts out black.
+        """
+        self.model = model.eval()
+        self.history = torch.zeros((num_envs, history_length, 15, 15))
+
+    def __call__(self, observations):
+        """ Return the key bit fields chosen for an array of observations of shape (num_envs, 15, 15). """
+        frames = torch.from_numpy(observations).float().unsqueeze(1)
+        self.history = torch.cat([frames, self.history[:, :-1]], dim=1)
+        with torch.no_grad():
+            prediction = self.model(self.history).cpu()
+        # Press each key with the probability predicted for it, like helper.get_key_state_from_vector
+        presses = prediction > torch.rand_like(prediction)
+        return label_store.encode_presses(presses.numpy())
+
+
+class VectorRunner:
+    """ Class running a policy on a VectorEnv.
+
+    Attributes:
+        policy_stats: helper.LatencyStats of the time taken by each policy call.
+    """
+
+    def __init__(self, env, policy):
+        """ Create VectorRunner instance.
+
+        Args:
+            env: VectorEnv to run.
+            policy: Callable returning the key bit fields of all instances for an observations array, e.g.
+                BatchedNNPolicy.
+        """
+        self.env = env
+        self.policy = policy
+        self.policy_stats = helper.LatencyStats()
+
+    def run(self, steps):
+        """ Reset the environment and run the policy for a number of steps.
+
+        Returns:
+            The number of decisions per second, summed over all instances.
+        """
+        observations = self.env.reset()
+        start = time.perf_counter()
+        for _ in range(steps):
+            with self.policy_stats.time():
+                key_bits = self.policy(observations)
+            observations = self.env.step(key_bits)
+        elapsed = time.perf_counter() - start
+        return steps * self.env.num_envs / elapsed if elapsed else 0.0
+
+    def summary(self):
+        return dict(policy=self.policy_stats.summary(), missed=self.env.missed,
+                    **{stage: stats.summary() for stage, stats in self.env.stats.items()})
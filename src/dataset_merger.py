@@ -2,7 +2,7 @@ import json
 import logging
 import os
 
-from src import helper
+from src import helper, label_store
 
 logger = logging.getLogger(__name__)
 
@@ -16,16 +16,9 @@ def merge(game_name, existing_data='log.json'):
     master_images = os.path.join(master_data_path, 'images')
     os.makedirs(master_images, exist_ok=True)
 
-    master_log_file = os.path.join(master_data_path, game_name + ".json")
-    # create master dataset if doesn't exist
-    if not os.path.exists(master_log_file):
-        with open(master_log_file, 'w') as f:
-            json.dump(dict(), f)
-    # get existing dataset
-    with open(master_log_file, 'r') as f:
-        json_file = json.load(f)
-        dataset_size = json_file.get('size', 0)
-        data = json_file.get('data', [])
+    # get existing dataset, creating the label store if it doesn't exist
+    store = label_store.open_game_store(game_name)
+    dataset_size = len(store)
     # get new data
     with open(os.path.join(output_dir, existing_data), 'r') as f:
         new_log = json.load(f).get('data')
@@ -33,6 +26,7 @@ def merge(game_name, existing_data='log.json'):
     # merge data
     logger.info("Initial dataset size: {}".format(dataset_size))
     count = dataset_size + 1
+    data = []
     for log in new_log:
         try:
             image_file_name = "{}.png".format(log['count'])
@@ -46,11 +40,10 @@ def merge(game_name, existing_data='log.json'):
         except FileNotFoundError:
             logger.error("image not found, skipping {}".format(count))
 
-    # save dataset
-    with open(master_log_file, 'w') as f:
-        json.dump({
-            "size": len(data),
-            "data": data
-        }, f)
+    # append new rows to the label store
+    store.append_records(data)
 
-    logger.info("Resulting dataset size after merge: {}".format(len(data)))
+    logger.info("Resulting dataset size after merge: {}".format(len(store)))
+    json_path = os.path.join(master_data_path, game_name + ".json")
+    if os.path.exists(json_path):
+        logger.warning("{} is no longer updated, the labels are stored in {}".format(json_path, store.path))
@@ -0,0 +1,109 @@
+""" This module packs a game's master dataset into contiguous, memory-mappable arrays.
+
+The packed dataset of a game is stored next to its master dataset as:
+    datasets/<game_name>/packed/frames.npy: uint8 array of shape (num_frames, height, width). Row i holds image i + 1.
+    datasets/<game_name>/packed/presses.npy: uint8 array of shape (num_records, len(keylog.Keyboard)).
+    datasets/<game_name>/packed/counts.npy: int32 array of shape (num_records,) holding the image count of each record.
+"""
+
+import logging
+import os
+
+import cv2
+import numpy as np
+
+from src import helper, label_store
+
+logger = logging.getLogger(__name__)
+
+FRAMES_FILE = "frames.npy"
+PRESSES_FILE = "presses.npy"
+COUNTS_FILE = "counts.npy"
+
+
+def get_packed_folder(game_name):
+    return os.path.join(helper.get_dataset_folder(), game_name, "packed")
+
+
+def pack(game_name):
+    """ Pack the images and key presses of a master dataset into contiguous uint8 arrays.
+
+    Args:
+        game_name: Name of the master dataset folder in datasets/, e.g. 'mario_kart'.
+    """
+    master_data_path = os.path.join(helper.get_dataset_folder(), game_name)
+    image_dir = os.path.join(master_data_path, "images")
+    packed_dir = get_packed_folder(game_name)
+    os.makedirs(packed_dir, exist_ok=True)
+
+    store = label_store.open_game_store(game_name, create=False)
+    if len(store) == 0:
+        raise ValueError("master dataset for {} is empty.".format(game_name))
+    counts = store.counts()
+    presses = store.presses()
+
+    # Frame i + 1 is stored in row i so that history lookups stay simple index arithmetic
+    num_frames = int(counts.max())
+    first = None
+    for count in counts:
+        first = _read_frame(os.path.join(image_dir, "{}.png".format(count)))
+        if first is not None:
+            break
+        logger.warning("image {} not found, taking the frame shape from the next labelled image".format(count))
+    if first is None:
+        raise ValueError("none of the labelled images of {} can be read, e.g. {}.".format(
+            game_name, os.path.join(image_dir, "{}.png".format(counts[0]))))
+    frames = np.lib.format.open_memmap(os.path.join(packed_dir, FRAMES_FILE), mode='w+', dtype=np.uint8,
+                                       shape=(num_frames,) + first.shape)
+    previous = first
+    for count in range(1, num_frames + 1):
+        image = _read_frame(os.path.join(image_dir, "{}.png".format(count)))
+        if image is None:
+            logger.warning("image {} not found, using last image found".format(count))
+            image = previous
+        frames[count - 1] = image
+        previous = image
+    frames.flush()
+    del frames
+
+    np.save(os.path.join(packed_dir, PRESSES_FILE), presses)
+    np.save(os.path.join(packed_dir, COUNTS_FILE), counts)
+    logger.info("Packed {} frames and {} records into {}".format(num_frames, len(counts), packed_dir))
+
+
+def load(game_name, mmap_mode='c'):
+    """ Memory-map the packed dataset of a game, packing it first if it does not exist yet or is out of date with
+    the label store of the master dataset.
+
+    Args:
+        game_name: Name of the master dataset folder in datasets/, e.g. 'mario_kart'.
+        mmap_mode: Memory-map mode passed to numpy.load. The default copy-on-write mode yields writable arrays that
+            can be wrapped by torch.from_numpy without copying, while leaving the files on disk untouched.
+
+    Returns:
+        frames, presses, counts arrays as described in the module docstring.
+    """
+    packed_dir = get_packed_folder(game_name)
+    paths = [os.path.join(packed_dir, name) for name in (FRAMES_FILE, PRESSES_FILE, COUNTS_FILE)]
+    if not all(os.path.exists(path) for path in paths) or _is_stale(game_name, paths[1], paths[2]):
+        pack(game_name)
+    return tuple(np.load(path, mmap_mode=mmap_mode) for path in paths)
+
+
+def _is_stale(game_name, presses_path, counts_path):
+    # The packed labels must match the label store row for row. Without a label store there is nothing to repack from.
+    try:
+        store = label_store.open_game_store(game_name, create=False)
+    except FileNotFoundError:
+        return False
+    counts = np.load(counts_path, mmap_mode='r')
+    if len(counts) != len(store):
+        return True
+    return not (np.array_equal(counts, store.counts()) and
+                np.array_equal(np.load(presses_path, mmap_mode='r'), store.presses()))
+
+
+def _read_frame(img_path):
+    # Downsampled images are saved as grayscale, use the same channel as helper.get_tensor
+    image = cv2.imread(img_path)
+    return None if image is None else image[:, :, 1]
@@ -5,7 +5,9 @@ Note: More information about the Dolphin emulator can be found at:
     https://github.com/dolphin-emu/dolphin
 """
 
+import asyncio
 import enum
+import errno
 import logging
 import os
 import time
@@ -44,31 +46,240 @@ class Stick(enum.Enum):
     C = 1
 
 
-class DolphinController:
+# Commands and names of the controller elements, indexed by their enum values
+PRESS_COMMANDS = dict((button.value, 'PRESS {}\n'.format(button.name)) for button in Button)
+RELEASE_COMMANDS = dict((button.value, 'RELEASE {}\n'.format(button.name)) for button in Button)
+TRIGGER_NAMES = dict((trigger.value, trigger.name) for trigger in Trigger)
+STICK_NAMES = dict((stick.value, stick.name) for stick in Stick)
+ALL_BUTTONS = sum(1 << button.value for button in Button)
+
+
+class ControllerState:
+    """ Complete input state of a Dolphin controller.
+
+    Attributes:
+        buttons: Bitmask of the pressed buttons, bit n is set if the Button with value n is pressed.
+        triggers: List with how far down each Trigger is pressed, indexed by Trigger value.
+        sticks: List with the (x, y) position of each Stick, indexed by Stick value.
+    """
+
+    def __init__(self, buttons=0, triggers=None, sticks=None):
+        self.buttons = buttons
+        self.triggers = list(triggers) if triggers is not None else [0.0] * len(Trigger)
+        self.sticks = list(sticks) if sticks is not None else [(0.5, 0.5)] * len(Stick)
+
+    def __eq__(self, other):
+        return (self.buttons, self.triggers, self.sticks) == (other.buttons, other.triggers, other.sticks)
+
+    def copy(self):
+        return ControllerState(self.buttons, self.triggers, self.sticks)
+
+    def is_pressed(self, button):
+        return bool(self.buttons >> button.value & 1)
+
+    def press(self, button):
+        self.buttons |= 1 << button.value
+
+    def release(self, button):
+        self.buttons &= ~(1 << button.value)
+
+    def set_trigger(self, trigger, amount):
+        """ Set how far down a trigger is pressed, see DolphinController.set_trigger. """
+        assert 0 <= amount <= 1
+        # Round to the precision sent to Dolphin so that unchanged values are recognized
+        self.triggers[trigger.value] = round(amount, 2)
+
+    def set_stick(self, stick, x, y):
+        """ Set the location of a stick, see DolphinController.set_stick. """
+        assert 0 <= x <= 1 and 0 <= y <= 1
+        self.sticks[stick.value] = (round(x, 2), round(y, 2))
+
+    def apply(self, command):
+        """ Update the state with a single fifo pipe command line, e.g. 'PRESS A' or 'SET MAIN 0.50 0.50'. """
+        action, name, *values = command.split()
+        if action == 'PRESS':
+            self.press(Button[name])
+        elif action == 'RELEASE':
+            self.release(Button[name])
+        elif action == 'SET' and name in Trigger.__members__:
+            self.set_trigger(Trigger[name], float(values[0]))
+        elif action == 'SET' and name in Stick.__members__:
+            self.set_stick(Stick[name], float(values[0]), float(values[1]))
+        else:
+            raise ValueError("Unknown controller command {}".format(command))
+
+    def commands(self, previous=None):
+        """ Return the fifo pipe commands changing the controller from a previous state to this one.
+
+        Args:
+            previous: ControllerState the controller is currently in. If None, commands for every element are returned.
+
+        Returns:
+            List of command lines, only including the elements that differ from the previous state.
+        """
+        commands = []
+        changed = self.buttons ^ previous.buttons if previous is not None else ALL_BUTTONS
+        # Visit the changed buttons only, lowest bit first
+        while changed:
+            value = (changed & -changed).bit_length() - 1
+            changed &= changed - 1
+            commands.append(PRESS_COMMANDS[value] if self.buttons >> value & 1 else RELEASE_COMMANDS[value])
+        for value, amount in enumerate(self.triggers):
+            if previous is None or amount != previous.triggers[value]:
+                commands.append('SET {} {:.2f}\n'.format(TRIGGER_NAMES[value], amount))
+        for value, position in enumerate(self.sticks):
+            if previous is None or position != previous.sticks[value]:
+                commands.append('SET {} {:.2f} {:.2f}\n'.format(STICK_NAMES[value], *position))
+        return commands
+
+
+class FrameInput(ControllerState):
+    """ Transaction collecting the controller input of one frame.
+
+    Starts from the current state of the controller, or a neutral state if cleared, and sends the difference to it as a
+    single write when the with block exits without an exception:
+
+        with controller.frame() as frame:
+            frame.press(Button.A)
+            frame.set_stick(Stick.MAIN, 0.33, 0.5)
+
+    Use async with for an AsyncDolphinController.
+    """
+
+    def __init__(self, controller, clear=False):
+        state = ControllerState() if clear else controller.state
+        super().__init__(state.buttons, state.triggers, state.sticks)
+        self.controller = controller
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.controller.send_state(self)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, *args):
+        if exc_type is None:
+            await self.controller.send_state(self)
+
+
+class _BaseController:
+    """ Command encoding and statistics shared by DolphinController and AsyncDolphinController.
+
+    Subclasses provide _write(commands), which writes command lines to the pipe and returns the number of write system
+    calls made, and wrap the helpers below around it.
+
+    Attributes:
+        state: ControllerState last sent to Dolphin.
+        log_commands: Whether to log every command sent.
+        writes: Total number of write system calls made on the pipe.
+        frames: Number of controller states sent with send_state().
+        frame_writes: Number of write system calls made by the last send_state().
+    """
+
+    def __init__(self, path, log_commands=True):
+        self.path = os.path.expanduser(path)
+        self.log_commands = log_commands
+        self.state = ControllerState()
+        self.writes = 0
+        self.frames = 0
+        self.frame_writes = 0
+        self._total_frame_writes = 0
+
+    @property
+    def writes_per_frame(self):
+        """ Average number of write system calls per frame sent with send_state(). """
+        return self._total_frame_writes / self.frames if self.frames else 0.0
+
+    def frame(self, clear=False):
+        """ Start a FrameInput transaction, sent when its with block exits.
+
+        Args:
+            clear: Whether to start from a neutral controller instead of the current state, so that only the elements
+                set in the transaction are pressed.
+        """
+        return FrameInput(self, clear=clear)
+
+    def _encode(self, commands):
+        """ Return command lines as the bytes written to the pipe, logging them if enabled. """
+        if self.log_commands:
+            logger.info("\n {}".format(' '.join(commands)))
+        return memoryview(''.join(commands).encode('ascii'))
+
+    def _state_commands(self, state, full=False):
+        """ Return the commands bringing the controller into a state and record it as sent. """
+        commands = state.commands(None if full else self.state)
+        self.state = state.copy()
+        return commands
+
+    def _count_frame(self, writes):
+        """ Record the write system calls of a frame sent with send_state() and return their number. """
+        self.frame_writes = writes
+        self._total_frame_writes += writes
+        self.frames += 1
+        return writes
+
+    def _press_commands(self, button):
+        assert button in Button
+        self.state.press(button)
+        return [PRESS_COMMANDS[button.value]]
+
+    def _release_commands(self, button):
+        assert button in Button
+        self.state.release(button)
+        return [RELEASE_COMMANDS[button.value]]
+
+    def _trigger_commands(self, trigger, amount):
+        assert trigger in Trigger
+        self.state.set_trigger(trigger, amount)
+        return ['SET {} {:.2f}\n'.format(trigger.name, amount)]
+
+    def _stick_commands(self, stick, x, y):
+        assert stick in Stick
+        self.state.set_stick(stick, x, y)
+        return ['SET {} {:.2f} {:.2f}\n'.format(stick.name, x, y)]
+
+
+class DolphinController(_BaseController):
     """ Class allowing user to send controller inputs to Dolphin programmatically using fifo pipes.
 
+    The controller keeps track of the state it has sent to Dolphin. Whole frames of input can be sent with frame() or
+    send_state(), which write only the elements that changed in a single write to the pipe.
+
+    Attributes:
+        state: ControllerState last sent to Dolphin.
+        log_commands: Whether to log every command sent.
+        writes: Total number of write system calls made on the pipe.
+        frames: Number of controller states sent with send_state().
+        frame_writes: Number of write system calls made by the last send_state().
+
     Note:
         Currently only functional on Linux operating systems. See below for more info:
         https://wiki.dolphin-emu.org/index.php?title=Pipe_Input
     """
 
-    def __init__(self, path):
+    def __init__(self, path, log_commands=True):
         """ Create DolphinController instance, but do not open the fifo pipe.
 
         Args:
             path: Location of the Dolphin fifo pipe configuration file
+            log_commands: Whether to log every command sent. Disable when sending input every frame.
 
         Note:
             The Dolphin fifo pipe configuration file is often located at:
             ~/.dolphin-emu/Pipes/pipe
         """
+        super().__init__(path, log_commands)
         self.pipe = None
-        self.path = os.path.expanduser(path)
         logger.info("Controller pad initialized.")
 
     def __enter__(self):
         """ Open the fifo pipe. Blocks until the other side is listening. """
-        self.pipe = open(self.path, 'w', buffering=1)
+        # Unbuffered, every _write() goes straight to the pipe
+        self.pipe = open(self.path, 'wb', buffering=0)
         logger.info("Pipe opened.")
         return self
 
@@ -78,15 +289,43 @@ class DolphinController:
             self.pipe.close()
             logger.info("Pipe closed.")
 
+    def _write(self, commands):
+        """ Write command lines to the pipe in as few write system calls as possible.
+
+        Returns:
+            The number of write system calls made.
+        """
+        if not commands:
+            return 0
+        data = self._encode(commands)
+        writes = 0
+        # A single write unless the pipe is full and only accepts part of the data
+        while data:
+            written = self.pipe.write(data)
+            writes += 1
+            data = data[written:]
+        self.writes += writes
+        return writes
+
+    def send_state(self, state, full=False):
+        """ Bring the Dolphin controller into a given state with a single write of the elements that changed.
+
+        Args:
+            state: ControllerState to send.
+            full: Whether to send every element, e.g. when the state of the Dolphin controller is unknown.
+
+        Returns:
+            The number of write system calls made.
+        """
+        return self._count_frame(self._write(self._state_commands(state, full)))
+
     def press_button(self, button):
         """ Press a Dolphin controller button.
 
         Args:
             button: The Dolphin controller button to press. Must be a supported Dolphin button.
         """
-        assert button in Button
-        self.pipe.write('PRESS {}\n'.format(button.name))
-        logger.info("\n {} pressed".format(button.name))
+        self._write(self._press_commands(button))
 
     def release_button(self, button):
         """ Release a Dolphin controller button.
@@ -94,9 +333,7 @@ class DolphinController:
         Args:
             button: The Dolphin controller button to release. Must be a supported Dolphin button.
         """
-        assert button in Button
-        self.pipe.write('RELEASE {}\n'.format(button.name))
-        logger.info("\n {} released".format(button.name))
+        self._write(self._release_commands(button))
 
     def press_release_button(self, button, delay):
         """ Press and release a Dolphin controller button.
@@ -118,9 +355,7 @@ class DolphinController:
                 0 indicates the trigger is released, and 1 indicates the controller is fully pressed
                 down.
         """
-        assert trigger in Trigger
-        assert 0 <= amount <= 1
-        self.pipe.write('SET {} {:.2f}\n'.format(trigger.name, amount))
+        self._write(self._trigger_commands(trigger, amount))
 
     def set_stick(self, stick, x, y):
         """ Set the location of a Dolphin controller stick/joystick.
@@ -132,15 +367,108 @@ class DolphinController:
             y: The y position of the stick. Must be a value between 0 and 1. 0.5 indicates the trigger
                 is neutral, 1 is full up, and -1 is full down.
         """
-        assert stick in Stick
-        assert 0 <= x <= 1 and 0 <= y <= 1
-        self.pipe.write('SET {} {:.2f} {:.2f}\n'.format(stick.name, x, y))
+        self._write(self._stick_commands(stick, x, y))
 
     def reset(self):
-        """ Reset all Dolphin controller elements to released or neutral position. """
-        for button in Button:
-            self.release_button(button)
-        for trigger in Trigger:
-            self.set_trigger(trigger, 0)
-        for stick in Stick:
-            self.set_stick(stick, 0.5, 0.5)
+        """ Reset all Dolphin controller elements to released or neutral position with a single write. """
+        self.send_state(ControllerState(), full=True)
+
+
+class AsyncDolphinController(_BaseController):
+    """ asyncio version of DolphinController writing to the fifo pipe through a non-blocking file descriptor.
+
+    Writes never block the event loop: if the pipe is full, the controller waits for it to become writable again.
+    Attributes are the same as those of DolphinController.
+    """
+
+    def __init__(self, path, log_commands=True, poll_interval=0.01):
+        """ Create AsyncDolphinController instance, but do not open the fifo pipe.
+
+        Args:
+            path: Location of the Dolphin fifo pipe configuration file
+            log_commands: Whether to log every command sent. Disable when sending input every frame.
+            poll_interval: Number of seconds between attempts to open the pipe while Dolphin is not listening yet.
+        """
+        super().__init__(path, log_commands)
+        self.fd = None
+        self.poll_interval = poll_interval
+
+    async def open(self):
+        """ Open the fifo pipe. Waits without blocking the event loop until the other side is listening. """
+        while self.fd is None:
+            try:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            except OSError as e:
+                # Opening a fifo for non-blocking writes fails with ENXIO as long as there is no reader
+                if e.errno != errno.ENXIO:
+                    raise
+                await asyncio.sleep(self.poll_interval)
+        logger.info("Pipe opened.")
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+            logger.info("Pipe closed.")
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, *args):
+        self.close()
+
+    async def _write(self, commands):
+        """ Write command lines to the pipe, waiting for it to drain whenever it is full.
+
+        Returns:
+            The number of write system calls made.
+        """
+        if not commands:
+            return 0
+        data = self._encode(commands)
+        writes = 0
+        while data:
+            writes += 1
+            try:
+                data = data[os.write(self.fd, data):]
+            except BlockingIOError:
+                await self._writable()
+        self.writes += writes
+        return writes
+
+    async def _writable(self):
+        """ Wait until the pipe accepts more data. """
+        loop = asyncio.get_running_loop()
+        writable = loop.create_future()
+        loop.add_writer(self.fd, lambda: writable.done() or writable.set_result(None))
+        try:
+            await writable
+        finally:
+            loop.remove_writer(self.fd)
+
+    async def send_state(self, state, full=False):
+        """ Bring the Dolphin controller into a given state, see DolphinController.send_state. """
+        return self._count_frame(await self._write(self._state_commands(state, full)))
+
+    async def press_button(self, button):
+        await self._write(self._press_commands(button))
+
+    async def release_button(self, button):
+        await self._write(self._release_commands(button))
+
+    async def press_release_button(self, button, delay):
+        """ Press and release a Dolphin controller button, yielding to the event loop in between. """
+        await self.press_button(button)
+        await asyncio.sleep(delay)
+        await self.release_button(button)
+
+    async def set_trigger(self, trigger, amount):
+        await self._write(self._trigger_commands(trigger, amount))
+
+    async def set_stick(self, stick, x, y):
+        await self._write(self._stick_commands(stick, x, y))
+
+    async def reset(self):
+        """ Reset all Dolphin controller elements to released or neutral position with a single write. """
+        await self.send_state(ControllerState(), full=True)
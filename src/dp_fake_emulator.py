@@ -0,0 +1,87 @@
+""" This module provides a fake Dolphin emulator for running agents without Dolphin, e.g. in tests and benchmarks.
+
+A FakeEmulator process stands in for a Dolphin instance started with its own user directory. It reads controller
+commands from the instance's fifo pipe at <user_dir>/Pipes/pipe like Dolphin's pipe input does, and writes frames into a
+dp_frame_source.SharedMemoryRingBuffer at a fixed rate. Every frame is a uniform gray image whose brightness encodes the
+controller state, so the effect of the input sent to an instance shows up in the frames it produces.
+"""
+
+import logging
+import multiprocessing
+import os
+import select
+import time
+
+import numpy as np
+
+from src import dp_controller, dp_frame_source
+
+logger = logging.getLogger(__name__)
+
+
+def state_brightness(state):
+    """ Return the gray level of the frames shown for a dp_controller.ControllerState. """
+    x, y = state.sticks[dp_controller.Stick.MAIN.value]
+    return (state.buttons * 7 + int(x * 100) + int(y * 10)) % 256
+
+
+class FakeEmulator(multiprocessing.Process):
+    """ Process consuming fifo pipe controller commands and producing frames.
+
+    Attributes:
+        pipe_path: Location of the fifo pipe the controller commands are read from.
+        commands: multiprocessing.Value with the number of commands received.
+    """
+
+    def __init__(self, user_dir, ring_name, fps=60):
+        """ Create FakeEmulator instance, creating its fifo pipe. Call start() to begin consuming and producing.
+
+        Args:
+            user_dir: Dolphin user directory of the fake instance.
+            ring_name: Name of an existing SharedMemoryRingBuffer the frames are written to.
+            fps: Number of frames written per second.
+        """
+        super().__init__(daemon=True)
+        self.pipe_path = os.path.join(os.path.expanduser(user_dir), 'Pipes', 'pipe')
+        os.makedirs(os.path.dirname(self.pipe_path), exist_ok=True)
+        if not os.path.exists(self.pipe_path):
+            os.mkfifo(self.pipe_path)
+        self.ring_name = ring_name
+        self.fps = fps
+        self.commands = multiprocessing.Value('i', 0)
+        self.stop_event = multiprocessing.Event()
+
+    def run(self):
+        ring = dp_frame_source.SharedMemoryRingBuffer(self.ring_name)
+        # A non-blocking reader can be opened before the controller connects
+        fd = os.open(self.pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+        state = dp_controller.ControllerState()
+        frame = np.empty(ring.shape, dtype=np.uint8)
+        pending = b''
+        period = 1.0 / self.fps
+        next_time = time.perf_counter()
+        try:
+            while not self.stop_event.is_set():
+                timeout = max(next_time - time.perf_counter(), 0)
+                if select.select([fd], [], [], timeout)[0]:
+                    data = os.read(fd, 4096)
+                    if data:
+                        *lines, pending = (pending + data).split(b'\n')
+                        for line in lines:
+                            state.apply(line.decode('ascii'))
+                        with self.commands.get_lock():
+                            self.commands.value += len(lines)
+                    else:
+                        # No writer connected, the pipe reads as end of file until one is
+                        time.sleep(timeout)
+                if time.perf_counter() >= next_time:
+                    frame.fill(state_brightness(state))
+                    ring.write(frame)
+                    next_time += period
+        finally:
+            os.close(fd)
+            ring.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -0,0 +1,259 @@
+""" This module provides sources of Dolphin emulator frames for the AI agents.
+
+A frame source hands the agents each new frame as a BGR numpy array of shape (height, width, 3):
+    ScreenshotFrameSource: Triggers a Dolphin screenshot and reads the resulting png file back from disk as soon as
+        Dolphin has finished saving it.
+    SharedMemoryFrameSource: Reads frames from a shared memory ring buffer without touching the disk. The ring buffer
+        is fed by a frame producer, e.g. SyntheticFrameProducer which stands in for an emulator-side frame grabber.
+"""
+
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from src import dp_screenshot, helper
+
+logger = logging.getLogger(__name__)
+
+# Default Dolphin screenshot resolution
+FRAME_SHAPE = (528, 640, 3)
+
+
+class FrameSource:
+    """ Base class of all frame sources.
+
+    Attributes:
+        reuses_buffer: Whether the returned frames are overwritten by the next call, so must be copied to be kept.
+    """
+    reuses_buffer = False
+
+    def next_frame(self):
+        """ Return the next frame as a BGR uint8 array, or None if no frame could be captured. """
+        raise NotImplementedError
+
+    async def next_frame_async(self):
+        """ Coroutine version of next_frame. Runs next_frame in the default executor unless overridden. """
+        return await asyncio.get_running_loop().run_in_executor(None, self.next_frame)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScreenshotFrameSource(FrameSource):
+    """ Frame source using Dolphin's screenshot hot-key and the screenshot folder. """
+
+    def __init__(self, game_name, timeout=1.0, screenshot_dir=None):
+        """ Create ScreenshotFrameSource instance.
+
+        Args:
+            game_name: Game ID used by Dolphin to name the screenshot folder and files, e.g. NABE01.
+            timeout: Maximum number of seconds to wait for Dolphin to save the screenshot.
+            screenshot_dir: Folder Dolphin saves the game's screenshots to. Defaults to
+                ~/.dolphin-emu/ScreenShots/<game_name>
+        """
+        if screenshot_dir is None:
+            screenshot_dir = os.path.join(helper.get_home_folder(), '.dolphin-emu', 'ScreenShots', game_name)
+        self.screenshot_name = '{}-1.png'.format(game_name)
+        self.waiter = dp_screenshot.ScreenshotWaiter(screenshot_dir, timeout=timeout)
+
+    @property
+    def wait_stats(self):
+        """ helper.LatencyStats of the time between requesting a screenshot and it being saved. """
+        return self.waiter.stats
+
+    def next_frame(self):
+        start = time.perf_counter()
+        dp_screenshot.take_screenshot()
+        screenshot_file = self.waiter.wait(self.screenshot_name, start=start)
+        if screenshot_file is None:
+            return None
+        frame = cv2.imread(screenshot_file)
+        # Delete used screenshot file so that Dolphin saves the next one under the same name
+        os.unlink(screenshot_file)
+        return frame
+
+    async def next_frame_async(self):
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        await loop.run_in_executor(None, dp_screenshot.take_screenshot)
+        screenshot_file = await self.waiter.wait_async(self.screenshot_name, start=start)
+        if screenshot_file is None:
+            return None
+        frame = await loop.run_in_executor(None, cv2.imread, screenshot_file)
+        os.unlink(screenshot_file)
+        return frame
+
+    def close(self):
+        self.waiter.close()
+
+
+class SharedMemoryRingBuffer:
+    """ Fixed-size ring of frames in shared memory.
+
+    The buffer starts with a header of 8 int64 values: the number of frames written so far, the capacity of the ring
+    and the frame shape. Frame n is written to slot n % capacity before the write count is incremented.
+    """
+    HEADER_SIZE = 8
+
+    def __init__(self, name=None, shape=FRAME_SHAPE, capacity=4, create=False):
+        """ Create or attach to a shared memory ring buffer.
+
+        Args:
+            name: Name of the shared memory block. A unique name is generated when creating a buffer without one.
+            shape: Shape of a single uint8 frame, only used when creating the buffer.
+            capacity: Number of frame slots, only used when creating the buffer.
+            create: Whether to create a new buffer rather than attaching to an existing one.
+        """
+        header_bytes = self.HEADER_SIZE * np.dtype(np.int64).itemsize
+        if create:
+            size = header_bytes + capacity * int(np.prod(shape))
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            self.header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+            self.header[:] = 0
+            self.header[1] = capacity
+            self.header[2:2 + len(shape)] = shape
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            self.header = np.ndarray((self.HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+        self.owner = create
+        self.capacity = int(self.header[1])
+        self.shape = tuple(int(d) for d in self.header[2:self.HEADER_SIZE] if d)
+        self.slots = np.ndarray((self.capacity,) + self.shape, dtype=np.uint8, buffer=self.shm.buf,
+                                offset=header_bytes)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def write_count(self):
+        return int(self.header[0])
+
+    def write(self, frame):
+        """ Copy a frame into the next slot of the ring. """
+        count = self.header[0]
+        self.slots[count % self.capacity] = frame
+        self.header[0] = count + 1
+
+    def read_latest(self, out):
+        """ Copy the most recently written frame into out.
+
+        Returns:
+            The write count the copied frame corresponds to, or 0 if nothing has been written yet.
+        """
+        while True:
+            count = self.write_count
+            if count == 0:
+                return 0
+            np.copyto(out, self.slots[(count - 1) % self.capacity])
+            # Retry if the writer wrapped around to the slot while it was being copied
+            if self.write_count - count < self.capacity - 1:
+                return count
+
+    def close(self):
+        self.slots = self.header = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SharedMemoryFrameSource(FrameSource):
+    """ Frame source reading the newest frame of a shared memory ring buffer. """
+    reuses_buffer = True
+
+    def __init__(self, ring_name, timeout=1.0, poll_interval=0.0005):
+        """ Create SharedMemoryFrameSource instance.
+
+        Args:
+            ring_name: Name of an existing SharedMemoryRingBuffer.
+            timeout: Number of seconds to wait for a new frame before giving up.
+            poll_interval: Number of seconds to sleep between checks for a new frame.
+        """
+        self.ring = SharedMemoryRingBuffer(ring_name)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.last_count = 0
+        self.frame = np.empty(self.ring.shape, dtype=np.uint8)
+
+    def next_frame(self):
+        """ Return the newest frame that has not been returned yet. Frames written in the meantime are skipped.
+
+        Note:
+            The returned array is reused and overwritten by the next call.
+        """
+        deadline = time.perf_counter() + self.timeout
+        while self.ring.write_count <= self.last_count:
+            if time.perf_counter() > deadline:
+                return None
+            time.sleep(self.poll_interval)
+        self.last_count = self.ring.read_latest(self.frame)
+        return self.frame
+
+    async def next_frame_async(self):
+        deadline = time.perf_counter() + self.timeout
+        while self.ring.write_count <= self.last_count:
+            if time.perf_counter() > deadline:
+                return None
+            await asyncio.sleep(self.poll_interval)
+        self.last_count = self.ring.read_latest(self.frame)
+        return self.frame
+
+    def close(self):
+        self.ring.close()
+
+
+class SyntheticFrameProducer(multiprocessing.Process):
+    """ Process writing frames into a shared memory ring buffer at a fixed rate.
+
+    Stands in for an emulator-side frame grabber. Frames are either cycled from a folder of images or random noise.
+    """
+
+    def __init__(self, ring_name, fps=30, image_dir=None):
+        """ Create SyntheticFrameProducer instance. Call start() to begin producing frames.
+
+        Args:
+            ring_name: Name of an existing SharedMemoryRingBuffer.
+            fps: Number of frames written per second.
+            image_dir: Optional folder of images to cycle through, resized to the ring buffer frame shape.
+        """
+        super().__init__(daemon=True)
+        self.ring_name = ring_name
+        self.fps = fps
+        self.image_dir = image_dir
+        self.stop_event = multiprocessing.Event()
+
+    def run(self):
+        ring = SharedMemoryRingBuffer(self.ring_name)
+        height, width = ring.shape[:2]
+        if self.image_dir:
+            frames = [cv2.resize(cv2.imread(os.path.join(self.image_dir, name)), (width, height))
+                      for name in sorted(os.listdir(self.image_dir))]
+        else:
+            rng = np.random.default_rng()
+            frames = [rng.integers(0, 256, ring.shape, dtype=np.uint8) for _ in range(ring.capacity + 1)]
+        period = 1.0 / self.fps
+        next_time = time.perf_counter()
+        for frame in itertools.cycle(frames):
+            if self.stop_event.is_set():
+                break
+            ring.write(frame)
+            next_time += period
+            time.sleep(max(next_time - time.perf_counter(), 0))
+        ring.close()
+
+    def stop(self):
+        self.stop_event.set()
+        self.join()
@@ -1,7 +1,9 @@
 """ This module provides tools for programmatic control of the Dolphin emulator's frame control functionality. """
 
 import logging
-import pyautogui
+import time
+
+from src import dp_hotkeys, helper
 
 logger = logging.getLogger(__name__)
 
@@ -14,9 +16,8 @@ def advance(slot_key):
             frame advance hot-key. P is often the default key.
     """
     try:
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key)
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error advancing frame {}:".format(slot_key))
 
 
@@ -28,9 +29,8 @@ def inc_speed(slot_key):
             frame speed hot-key. M is often the default key.
     """
     try:
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key)
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error increasing speed {}:".format(slot_key))
 
 
@@ -42,9 +42,8 @@ def dec_speed(slot_key):
             frame speed hot-key. N is often the default key.
     """
     try:
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key)
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error decreasing speed {}:".format(slot_key))
 
 
@@ -56,7 +55,27 @@ def res_speed(slot_key):
             frame speed hot-key. R is often the default key.
     """
     try:
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key)
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error resetting speed {}:".format(slot_key))
+
+
+def measure_advance_latency(frame_source, slot_key='P', frames=100):
+    """ Measure the time from pressing the frame advance hot-key to the advanced frame being available.
+
+    Args:
+        frame_source: dp_frame_source.FrameSource of the running Dolphin emulator.
+        slot_key: Keyboard key corresponding to the Dolphin emulator's frame advance hot-key.
+        frames: Number of frames to advance.
+
+    Returns:
+        helper.LatencyStats of the frame advance latencies. The hot-key part alone is in dp_hotkeys.get_backend().stats.
+    """
+    stats = helper.LatencyStats()
+    for _ in range(frames):
+        start = time.perf_counter()
+        advance(slot_key)
+        if frame_source.next_frame() is not None:
+            stats.add(time.perf_counter() - start)
+    logger.info("Frame advance latency: {}".format(stats.summary()))
+    return stats
@@ -0,0 +1,213 @@
+""" This module provides the backends sending keyboard hot-keys to the Dolphin emulator.
+
+Dolphin's frame advance, screenshot and save state functionality is controlled with hot-keys. A hot-key backend
+presses them on behalf of the other dp_* modules:
+    XTestBackend: Injects key events directly into the X server through libXtst, costing one X request per event.
+    PyAutoGuiBackend: Uses pyautogui, with its pause after every call disabled. Used when XTest is not available.
+    RecordingBackend: Only records the key events, for tests and runs without an emulator.
+
+Keys are named like pyautogui keys, e.g. 'p', 'f9' or 'shift'. A backend serializes its presses with a lock, so hot-keys
+can be sent from several threads, e.g. the executor threads of agent_runner, through one X display connection.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import threading
+import time
+
+from src import helper
+
+logger = logging.getLogger(__name__)
+
+# X keysym names of the pyautogui key names that differ
+XTEST_KEYSYM_NAMES = {
+    'shift': 'Shift_L',
+    'ctrl': 'Control_L',
+    'alt': 'Alt_L',
+    'enter': 'Return',
+    'esc': 'Escape',
+    'space': 'space',
+    'tab': 'Tab',
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+class HotkeyBackend:
+    """ Base class of all hot-key backends.
+
+    Attributes:
+        stats: helper.LatencyStats of the time taken by each press().
+        lock: Lock held while a press() sends its key events.
+    """
+
+    def __init__(self):
+        self.stats = helper.LatencyStats()
+        self.lock = threading.Lock()
+
+    def key_down(self, key):
+        raise NotImplementedError
+
+    def key_up(self, key):
+        raise NotImplementedError
+
+    def flush(self):
+        """ Make sure all key events have been sent. """
+        pass
+
+    def press(self, key, modifiers=()):
+        """ Press and release a key while holding down modifier keys.
+
+        Args:
+            key: Name of the key to press, e.g. 'p'.
+            modifiers: Names of keys held down while pressing key, e.g. ('shift',).
+        """
+        with self.lock:
+            start = time.perf_counter()
+            for modifier in modifiers:
+                self.key_down(modifier)
+            self.key_down(key)
+            self.key_up(key)
+            for modifier in reversed(modifiers):
+                self.key_up(modifier)
+            self.flush()
+            self.stats.add(time.perf_counter() - start)
+
+    def close(self):
+        pass
+
+
+class XTestBackend(HotkeyBackend):
+    """ Hot-key backend injecting key events into the X server with the XTest extension. """
+
+    def __init__(self, display_name=None):
+        """ Create XTestBackend instance, connecting to the X server.
+
+        Args:
+            display_name: X display to connect to, defaults to the DISPLAY environment variable.
+
+        Raises:
+            OSError: If libX11 or libXtst cannot be loaded or the display cannot be opened.
+        """
+        super().__init__()
+        x11_path = ctypes.util.find_library('X11')
+        xtst_path = ctypes.util.find_library('Xtst')
+        if not x11_path or not xtst_path:
+            raise OSError("libX11 and libXtst are required for the XTest hot-key backend.")
+        self.x11 = ctypes.CDLL(x11_path)
+        self.xtst = ctypes.CDLL(xtst_path)
+        self.x11.XOpenDisplay.restype = ctypes.c_void_p
+        self.x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        self.x11.XStringToKeysym.restype = ctypes.c_ulong
+        self.x11.XStringToKeysym.argtypes = [ctypes.c_char_p]
+        self.x11.XKeysymToKeycode.restype = ctypes.c_ubyte
+        self.x11.XKeysymToKeycode.argtypes = [ctypes.c_void_p, ctypes.c_ulong]
+        self.x11.XFlush.argtypes = [ctypes.c_void_p]
+        self.x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        self.xtst.XTestFakeKeyEvent.argtypes = [ctypes.c_void_p, ctypes.c_uint, ctypes.c_int, ctypes.c_ulong]
+        self.display = self.x11.XOpenDisplay(display_name.encode() if display_name else None)
+        if not self.display:
+            raise OSError("Could not open X display {}.".format(display_name or "from DISPLAY"))
+        self.keycodes = {}
+
+    def keycode(self, key):
+        """ Return the X keycode of a key name, looked up once per key. """
+        keycode = self.keycodes.get(key)
+        if keycode is None:
+            if helper.fkey_pattern.match(key):
+                keysym_name = key.upper()
+            else:
+                keysym_name = XTEST_KEYSYM_NAMES.get(key.lower(), key.lower())
+            keysym = self.x11.XStringToKeysym(keysym_name.encode())
+            keycode = self.x11.XKeysymToKeycode(self.display, keysym) if keysym else 0
+            if not keycode:
+                raise ValueError("Key {} has no X keycode.".format(key))
+            self.keycodes[key] = keycode
+        return keycode
+
+    def key_down(self, key):
+        self.xtst.XTestFakeKeyEvent(self.display, self.keycode(key), True, 0)
+
+    def key_up(self, key):
+        self.xtst.XTestFakeKeyEvent(self.display, self.keycode(key), False, 0)
+
+    def flush(self):
+        self.x11.XFlush(self.display)
+
+    def close(self):
+        with self.lock:
+            if self.display:
+                self.x11.XCloseDisplay(self.display)
+                self.display = None
+
+
+class PyAutoGuiBackend(HotkeyBackend):
+    """ Hot-key backend using pyautogui. """
+
+    def __init__(self, pause=0.0):
+        """ Create PyAutoGuiBackend instance.
+
+        Args:
+            pause: Number of seconds pyautogui sleeps after every call. Its default of 0.1 s would be spent on the
+                frame advance critical path.
+        """
+        super().__init__()
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.pyautogui.PAUSE = pause
+
+    def key_down(self, key):
+        self.pyautogui.keyDown(key)
+
+    def key_up(self, key):
+        self.pyautogui.keyUp(key)
+
+
+class RecordingBackend(HotkeyBackend):
+    """ Hot-key backend recording key events instead of sending them.
+
+    Attributes:
+        events: List of (time.perf_counter() time, 'down' or 'up', key name) tuples.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    def key_down(self, key):
+        self.events.append((time.perf_counter(), 'down', key))
+
+    def key_up(self, key):
+        self.events.append((time.perf_counter(), 'up', key))
+
+    def pressed_keys(self):
+        """ Return the list of keys pressed so far, in order. """
+        return [key for _, event, key in self.events if event == 'down']
+
+
+def get_backend():
+    """ Return the hot-key backend in use, creating an XTestBackend, or a PyAutoGuiBackend if XTest is unavailable. """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            try:
+                _backend = XTestBackend()
+            except OSError as e:
+                logger.info("XTest hot-keys unavailable ({}), falling back to pyautogui.".format(e))
+                _backend = PyAutoGuiBackend()
+        return _backend
+
+
+def set_backend(backend):
+    """ Use a hot-key backend for all hot-keys sent from now on. Returns the previous backend. """
+    global _backend
+    with _backend_lock:
+        previous, _backend = _backend, backend
+    return previous
+
+
+def press(key, modifiers=()):
+    """ Press a hot-key with the backend in use. See HotkeyBackend.press. """
+    get_backend().press(key, modifiers)
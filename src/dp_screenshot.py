@@ -1,10 +1,27 @@
 """ This module provides tools for programmatic control of the Dolphin emulator's screenshot functionality. """
 
-import pyautogui
+import asyncio
+import ctypes
+import ctypes.util
 import logging
+import os
+import select
+import time
+
+from src import dp_hotkeys, helper
 
 logger = logging.getLogger(__name__)
 
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Zero length IEND chunk closing every png file, including its CRC
+PNG_TRAILER = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
 
 def take_screenshot():
     """ Use Dolphin's screenshot ability to take a screenshot of the current Dolphin emulator state.
@@ -14,8 +31,128 @@ def take_screenshot():
         ~/.dolphin-emu/ScreenShots
     """
     try:
-        pyautogui.keyDown('f9')
-        pyautogui.keyUp('f9')
-    except (AssertionError, TypeError):
+        dp_hotkeys.press('f9')
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error taking screenshot")
         # TODO track which screenshots failed
+
+
+def is_complete_png(path):
+    """ Check whether a png file exists and has been written completely. """
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(PNG_SIGNATURE)) != PNG_SIGNATURE:
+                return False
+            f.seek(-len(PNG_TRAILER), os.SEEK_END)
+            return f.read() == PNG_TRAILER
+    except OSError:
+        return False
+
+
+class ScreenshotWaiter:
+    """ Class waiting for Dolphin to finish saving a screenshot.
+
+    Uses inotify to wake up as soon as a file in the screenshot folder is written on Linux, and polls the folder on
+    other systems. A screenshot is ready once it is a complete png file.
+
+    Attributes:
+        stats: helper.LatencyStats of the time spent waiting for each screenshot.
+        timeouts: Number of screenshots that did not arrive in time.
+    """
+
+    def __init__(self, screenshot_dir, timeout=1.0, poll_interval=0.002):
+        """ Create ScreenshotWaiter instance.
+
+        Args:
+            screenshot_dir: Folder Dolphin saves the screenshots to.
+            timeout: Maximum number of seconds to wait for a screenshot.
+            poll_interval: Number of seconds between checks when inotify is not available.
+        """
+        self.screenshot_dir = screenshot_dir
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.stats = helper.LatencyStats()
+        self.timeouts = 0
+        os.makedirs(screenshot_dir, exist_ok=True)
+        self.inotify_fd = self._watch(screenshot_dir)
+
+    def wait(self, file_name, start=None):
+        """ Wait until a screenshot has been saved completely.
+
+        Args:
+            file_name: Name of the screenshot file in the screenshot folder.
+            start: time.perf_counter() value the wait time is measured from, e.g. when the screenshot was requested.
+                Defaults to now.
+
+        Returns:
+            The path of the screenshot, or None if it was not saved within the timeout.
+        """
+        path = os.path.join(self.screenshot_dir, file_name)
+        start = time.perf_counter() if start is None else start
+        deadline = start + self.timeout
+        while not is_complete_png(path):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.timeouts += 1
+                logger.warning("Screenshot {} not saved within {} s".format(file_name, self.timeout))
+                return None
+            if self.inotify_fd is None:
+                time.sleep(min(self.poll_interval, remaining))
+            elif select.select([self.inotify_fd], [], [], remaining)[0]:
+                # Drain pending events, the file itself is checked again above
+                os.read(self.inotify_fd, 4096)
+        self.stats.add(time.perf_counter() - start)
+        return path
+
+    async def wait_async(self, file_name, start=None):
+        """ Wait until a screenshot has been saved completely without blocking the event loop. See wait().
+
+        Returns:
+            The path of the screenshot, or None if it was not saved within the timeout.
+        """
+        path = os.path.join(self.screenshot_dir, file_name)
+        start = time.perf_counter() if start is None else start
+        deadline = start + self.timeout
+        loop = asyncio.get_running_loop()
+        while not is_complete_png(path):
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                self.timeouts += 1
+                logger.warning("Screenshot {} not saved within {} s".format(file_name, self.timeout))
+                return None
+            if self.inotify_fd is None:
+                await asyncio.sleep(min(self.poll_interval, remaining))
+                continue
+            readable = loop.create_future()
+            loop.add_reader(self.inotify_fd, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, remaining)
+                os.read(self.inotify_fd, 4096)
+            except (asyncio.TimeoutError, BlockingIOError):
+                pass
+            finally:
+                loop.remove_reader(self.inotify_fd)
+        self.stats.add(time.perf_counter() - start)
+        return path
+
+    def close(self):
+        if self.inotify_fd is not None:
+            os.close(self.inotify_fd)
+            self.inotify_fd = None
+
+    @staticmethod
+    def _watch(directory):
+        """ Return an inotify file descriptor watching directory for written files, or None if unsupported. """
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+        if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+            logger.warning("inotify watch failed ({}), polling screenshot folder".format(
+                os.strerror(ctypes.get_errno())))
+            os.close(fd)
+            return None
+        return fd
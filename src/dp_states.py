@@ -1,8 +1,7 @@
 """ This module provides tools for programmatic control of the Dolphin emulator's save state functionality. """
 
 import logging
-import pyautogui
-from src import helper
+from src import dp_hotkeys, helper
 
 logger = logging.getLogger(__name__)
 
@@ -16,11 +15,8 @@ def save_dolphin_state(slot_key):
     """
     try:
         helper.validate_function_key(slot_key)
-        pyautogui.keyDown('shift')
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-        pyautogui.keyUp('shift')
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key, modifiers=('shift',))
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error saving state {}:".format(slot_key))
 
 
@@ -33,7 +29,6 @@ def load_dolphin_state(slot_key):
     """
     try:
         helper.validate_function_key(slot_key)
-        pyautogui.keyDown(slot_key)
-        pyautogui.keyUp(slot_key)
-    except (AssertionError, TypeError):
+        dp_hotkeys.press(slot_key)
+    except (AssertionError, TypeError, ValueError):
         logger.exception("Error loading state {}:".format(slot_key))
@@ -1,10 +1,14 @@
 """ Module containing miscellaneous helper functions. """
+import collections
+import contextlib
 import logging
 import pickle
 import re
 import os
 import random
+import time
 
+import numpy as np
 import torch
 
 from src import keylog
@@ -91,3 +95,33 @@ def get_key_state_from_vector(vector):
         rand_num = random.uniform(0, 1)
         key_state[key.name] = vector[i].data[0] > rand_num
     return key_state
+
+
+class LatencyStats:
+    """ Collects latency samples, in seconds, and summarises them. Only the most recent max_samples are kept. """
+
+    def __init__(self, max_samples=10000):
+        self.samples = collections.deque(maxlen=max_samples)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    @contextlib.contextmanager
+    def time(self):
+        """ Context manager adding the time spent inside the with block as a sample. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(time.perf_counter() - start)
+
+    def summary(self):
+        """ Return the total sample count and the mean, percentiles and max of the kept samples in milliseconds. """
+        if not self.samples:
+            return {"count": self.count}
+        ms = np.array(self.samples) * 1000
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        return {"count": self.count, "mean_ms": float(ms.mean()), "p50_ms": float(p50), "p95_ms": float(p95),
+                "p99_ms": float(p99), "max_ms": float(ms.max())}
@@ -1,91 +1,112 @@
+""" This module translates keyboard key press states into Dolphin controller input.
+
+The translation is compiled once into a table with the controller state of every combination of pressed keylog.Keyboard
+keys. Key press states are encoded as a bit field, bit i being set if the i-th member of keylog.Keyboard is pressed, so
+translating a frame of key states costs one table lookup no matter how many keys changed.
+"""
+
 import src.keylog as keylog
 from src import dp_controller
 
+KEY_NAMES = [key.name for key in keylog.Keyboard]
+
+# Controller button pressed by each keylog.Keyboard key, the only keys recorded and encoded in key bit fields. 'enter'
+# would press START, which is not sent to Dolphin
+KEY_BUTTONS = {
+    'x': dp_controller.Button.A,
+    'z': dp_controller.Button.B,
+    'c': dp_controller.Button.X,
+    's': dp_controller.Button.Y,
+    'd': dp_controller.Button.Z,
+}
+# MAIN stick axis (0 for x, 1 for y) and position on that axis set by each direction key. Directions on different axes
+# compose, e.g. left and up push the stick diagonally, while opposite directions cancel out
+KEY_STICK_POSITIONS = {
+    'left': (0, 0.33),
+    'right': (0, 0.66),
+    'up': (1, 1),
+    'down': (1, 0),
+}
+
+
+def _compile_states():
+    """ Return a list with the dp_controller.ControllerState of every keylog.Keyboard key bit field. """
+    states = []
+    for key_bits in range(1 << len(KEY_NAMES)):
+        state = dp_controller.ControllerState()
+        axes = ([], [])
+        for i, name in enumerate(KEY_NAMES):
+            if not key_bits >> i & 1:
+                continue
+            if name in KEY_BUTTONS:
+                state.press(KEY_BUTTONS[name])
+            elif name in KEY_STICK_POSITIONS:
+                axis, position = KEY_STICK_POSITIONS[name]
+                axes[axis].append(position)
+        x, y = (positions[0] if len(positions) == 1 else 0.5 for positions in axes)
+        state.set_stick(dp_controller.Stick.MAIN, x, y)
+        states.append(state)
+    return states
+
+
+KEY_STATES = _compile_states()
+
+
+def key_bits(keys):
+    """ Return the key bit field of a dict of key press states keyed by keylog.Keyboard names. """
+    bits = 0
+    for i, name in enumerate(KEY_NAMES):
+        if keys.get(name):
+            bits |= 1 << i
+    return bits
+
+
+def controller_state(keys):
+    """ Return the dp_controller.ControllerState of a dict of key press states. """
+    return KEY_STATES[key_bits(keys)].copy()
+
 
 class KeyPadMap:
-    def __init__(self):
-        self.previous_keys = dict((el.name, False) for el in keylog.Keyboard)
-        self.p = dp_controller.DolphinController("~/.dolphin-emu/Pipes/pipe").__enter__()
+    """ Class sending key press states to Dolphin as controller input.
+
+    Attributes:
+        key_bits: Key bit field of the key press states last sent.
+        p: dp_controller.DolphinController the input is sent through.
+    """
+
+    def __init__(self, pipe_path="~/.dolphin-emu/Pipes/pipe", log_commands=False, controller=None):
+        """ Create KeyPadMap instance, opening the Dolphin fifo pipe. Blocks until Dolphin is listening.
+
+        Args:
+            pipe_path: Location of the Dolphin fifo pipe configuration file.
+            log_commands: Whether the controller logs every command sent.
+            controller: Optional already opened dp_controller.DolphinController to use instead of opening pipe_path.
+        """
+        self.key_bits = 0
+        if controller is None:
+            controller = dp_controller.DolphinController(pipe_path, log_commands=log_commands).__enter__()
+        self.p = controller
+
+    @property
+    def previous_keys(self):
+        """ Dict of the key press states last sent. """
+        return dict((name, bool(self.key_bits >> i & 1)) for i, name in enumerate(KEY_NAMES))
 
     def update(self, keys):
-        # TODO track which keys are pressed and which are released.
-        # TODO track 'toggled' MAIN stick positions as well.
-        if self.previous_keys == {}:
-            self.previous_keys = keys
-            return
-        for key in keys:
-            # Ignore 'none'
-            if key == 'none':
-                continue
-            # Check for BUTTON
-            if key not in ('left', 'right', 'up', 'down'):
-                if keys[key]:
-                    if not self.previous_keys[key]:
-                        self.convert_key(key, is_press=1)
-                        self.previous_keys[key] = True
-                else:
-                    if self.previous_keys[key]:
-                        self.convert_key(key, is_press=0)
-                        self.previous_keys[key] = False
-
-            # Check for MAIN STICK
-            elif not keys[key]:
-                if self.previous_keys[key]:
-                    self.convert_key(key, is_press=0)
-                    self.previous_keys[key] = False
-
-            else:
-                if not self.previous_keys[key]:
-                    self.convert_key(key, is_press=1)
-                    self.previous_keys[key] = True
-
-    def convert_key(self, key, is_press):
-        # TODO organize in general way such that an controller input can be sent to pipe only knowing the key
-        key_pad = None
-        if key == 'x':
-            key_pad = dp_controller.Button.A
-        elif key == 'z':
-            key_pad = dp_controller.Button.B
-        elif key == 'c':
-            key_pad = dp_controller.Button.X
-        elif key == 's':
-            key_pad = dp_controller.Button.Y
-        elif key == 'd':
-            key_pad = dp_controller.Button.Z
-        elif key == 'enter':
-            key_pad = dp_controller.Button.START
-        elif key == 'left' or key == 'right' or key == 'up' or key == 'down':
-            key_pad = dp_controller.Stick.MAIN
-        elif key == 'w':
-            key_pad = dp_controller.Button.R
-        elif key == 'q':
-            key_pad = dp_controller.Button.L
-        elif key == 't':
-            key_pad = dp_controller.Button.D_UP
-        elif key == 'f':
-            key_pad = dp_controller.Button.D_LEFT
-        elif key == 'h':
-            key_pad = dp_controller.Button.D_RIGHT
-
-        # PRESS/RELEASE
-        if key_pad != dp_controller.Stick.MAIN:
-            if key_pad != dp_controller.Button.START:
-                if is_press == 1:
-                    self.p.press_button(key_pad)
-                else:
-                    self.p.release_button(key_pad)
-        # SET STICK
-        else:
-
-            if is_press == 1:
-                if key == 'left':
-                    self.p.set_stick(key_pad, x=0.33, y=0.5)
-                elif key == 'right':
-                    self.p.set_stick(key_pad, x=0.66, y=0.5)
-                elif key == 'up':
-                    self.p.set_stick(key_pad, x=0.5, y=1)
-                elif key == 'down':
-                    self.p.set_stick(key_pad, x=0.5, y=0)
-
-            else:
-                self.p.set_stick(key_pad, x=0.5, y=0.5)
+        """ Send a dict of key press states keyed by keylog.Keyboard names. Other keys are ignored.
+
+        Returns:
+            The number of writes to the pipe, at most one.
+        """
+        return self.update_bits(key_bits(keys))
+
+    def update_bits(self, bits):
+        """ Send key press states given as a key bit field, writing the changed controller elements in one write.
+
+        Returns:
+            The number of writes to the pipe, at most one.
+        """
+        if not bits ^ self.key_bits:
+            return 0
+        self.key_bits = bits
+        return self.p.send_state(KEY_STATES[bits])
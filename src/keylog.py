@@ -5,6 +5,7 @@ import logging
 import json
 import threading
 import os
+import time
 
 from pynput import keyboard
 from src import dp_screenshot, helper
@@ -46,8 +47,10 @@ class KeyLog:
     # Collect events until released
     def start(self):
         with keyboard.Listener(on_press=self.on_press, on_release=self.on_release) as listener:
-            self.record()
+            recorder = threading.Thread(target=self.record, daemon=True)
+            recorder.start()
             listener.join()
+            recorder.join()
             logger.info("Key logging session finished.")
 
     # on key press callback. sets pressed key state to 1. shows warning if key is not defined.
@@ -76,16 +79,19 @@ class KeyLog:
                 # Stop listener
                 return False
 
-    # log key press states while taking screenshots based on defined frequency
+    # log key press states while taking screenshots based on defined frequency, until finished. Ticks are scheduled
+    # from the start time so that the time spent taking a screenshot does not accumulate as drift
     def record(self):
-        if self.finish: return
-        threading.Timer(self.logging_delay, self.record).start()
-        dp_screenshot.take_screenshot()
-        self.log['data'].append({
-            "count": self.count,
-            "presses": dict(self.state)
-        })
-        self.count += 1
+        next_tick = time.perf_counter()
+        while not self.finish:
+            dp_screenshot.take_screenshot()
+            self.log['data'].append({
+                "count": self.count,
+                "presses": dict(self.state)
+            })
+            self.count += 1
+            next_tick += self.logging_delay
+            time.sleep(max(next_tick - time.perf_counter(), 0))
 
     def save_to_file(self, file_name="log.json"):
         output_dir = helper.get_output_folder()
@@ -0,0 +1,133 @@
+""" This module implements an append-only binary store for the key press labels of a game's master dataset.
+
+A label store file starts with an 8 byte header (b'DPLS', uint16 format version, uint16 number of keys) followed by
+one fixed-width little-endian row per frame:
+    count: uint32 image count of the frame, i.e. the frame is stored as images/<count>.png
+    keys: uint16 bit field, bit i is set if the i-th member of keylog.Keyboard was pressed
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+from src import helper, keylog
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'DPLS'
+VERSION = 1
+HEADER_DTYPE = np.dtype([('magic', 'S4'), ('version', '<u2'), ('num_keys', '<u2')])
+ROW_DTYPE = np.dtype([('count', '<u4'), ('keys', '<u2')])
+KEY_NAMES = [key.name for key in keylog.Keyboard]
+KEY_BITS = np.left_shift(1, np.arange(len(KEY_NAMES))).astype(np.uint16)
+
+
+def get_store_path(game_name):
+    return os.path.join(helper.get_dataset_folder(), game_name, game_name + ".keys")
+
+
+def open_game_store(game_name, create=True):
+    """ Open the label store of a master dataset, converting the legacy <game_name>.json log on first use.
+
+    Args:
+        game_name: Name of the master dataset folder in datasets/.
+        create: Whether to create an empty store if the game has neither a label store nor a json log. Otherwise a
+            FileNotFoundError is raised.
+    """
+    path = get_store_path(game_name)
+    if not os.path.exists(path):
+        json_path = os.path.join(helper.get_dataset_folder(), game_name, game_name + ".json")
+        if os.path.exists(json_path):
+            return from_json(json_path, path)
+        if not create:
+            raise FileNotFoundError("{} has no label store or json log.".format(game_name))
+    return LabelStore(path)
+
+
+def from_json(json_path, path):
+    """ Create a label store from a json key log of the form {"data": [{"count": ..., "presses": {...}}, ...]}.
+
+    The store is written under a temporary name and moved into place once complete, so that an interrupted conversion
+    is started over rather than leaving a partial store behind.
+    """
+    with open(json_path, 'r') as f:
+        data = json.load(f).get('data', [])
+    temporary_path = path + '.tmp'
+    if os.path.exists(temporary_path):
+        os.remove(temporary_path)
+    LabelStore(temporary_path).append_records(data)
+    os.replace(temporary_path, path)
+    logger.info("Converted {} records from {} to {}. {} is no longer updated.".format(len(data), json_path, path,
+                                                                                      json_path))
+    return LabelStore(path)
+
+
+def encode_presses(presses):
+    """ Convert an (n, len(keylog.Keyboard)) array of 0/1 press states to n key bit fields. """
+    presses = np.asarray(presses, dtype=bool).reshape(-1, len(KEY_NAMES))
+    return np.bitwise_or.reduce(np.where(presses, KEY_BITS, 0), axis=1).astype(np.uint16)
+
+
+def decode_keys(keys):
+    """ Convert n key bit fields to an (n, len(keylog.Keyboard)) uint8 array of 0/1 press states. """
+    return ((np.asarray(keys, dtype=np.uint16)[:, None] & KEY_BITS) != 0).astype(np.uint8)
+
+
+class LabelStore:
+    """ Append-only store of (count, key bit field) rows. Appending costs O(new rows). """
+
+    def __init__(self, path):
+        """ Open a label store, creating an empty one if the file does not exist.
+
+        Args:
+            path: Location of the label store file.
+        """
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            header = np.array([(MAGIC, VERSION, len(KEY_NAMES))], dtype=HEADER_DTYPE)
+            with open(path, 'wb') as f:
+                f.write(header.tobytes())
+        else:
+            header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+            if len(header) != 1 or header['magic'][0] != MAGIC or header['version'][0] != VERSION:
+                raise ValueError("{} is not a label store.".format(path))
+            if header['num_keys'][0] != len(KEY_NAMES):
+                raise ValueError("{} was written for {} keys, keylog.Keyboard has {}.".format(
+                    path, header['num_keys'][0], len(KEY_NAMES)))
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - HEADER_DTYPE.itemsize) // ROW_DTYPE.itemsize
+
+    def append(self, counts, presses):
+        """ Append rows to the end of the store.
+
+        Args:
+            counts: Image counts of the new frames.
+            presses: (n, len(keylog.Keyboard)) array of 0/1 press states of the new frames.
+        """
+        rows = np.empty(len(counts), dtype=ROW_DTYPE)
+        rows['count'] = counts
+        rows['keys'] = encode_presses(presses)
+        with open(self.path, 'ab') as f:
+            f.write(rows.tobytes())
+
+    def append_records(self, records):
+        """ Append keylog records of the form {"count": ..., "presses": {key name: 0/1}}. """
+        counts = [record['count'] for record in records]
+        presses = [[record['presses'].get(name, 0) for name in KEY_NAMES] for record in records]
+        self.append(counts, presses)
+
+    def rows(self):
+        """ Memory-map all rows of the store. """
+        if len(self) == 0:
+            return np.empty(0, dtype=ROW_DTYPE)
+        return np.memmap(self.path, dtype=ROW_DTYPE, mode='r', offset=HEADER_DTYPE.itemsize)
+
+    def counts(self):
+        return np.asarray(self.rows()['count'], dtype=np.int32)
+
+    def presses(self):
+        return decode_keys(self.rows()['keys'])
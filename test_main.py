@@ -9,8 +9,10 @@ import time
 import cv2
 import torch
 
-from src import dp_controller, keylog, mk_downsampler, key2pad, helper, dataset_merger
-from src.agents import state_model, mk_naive_agent, mk_nn
+from src import dp_controller, dp_fake_emulator, dp_frame_source, dp_frames, dp_hotkeys, keylog, mk_downsampler, \
+    key2pad, helper, dataset_merger, dataset_packer
+from src.agents import state_model, mk_naive_agent, mk_nn, mk_dataset, agent_runner, frame_scheduler, vector_env, \
+    agent_benchmark
 from src.agents.mk_nn_train import MKNN
 from src.agents.mk_rnn_lstm_train import MKRNN_lstm
 from src.agents.mk_cnn_train import MKCNN
@@ -27,6 +29,26 @@ def test_dolphin_controller():
         time.sleep(0.1)
 
 
+def test_controller_frames(frames=60):
+    """ Check that whole frames of controller input are sent to Dolphin with a single write each. """
+    with dp_controller.DolphinController("~/.dolphin-emu/Pipes/pipe", log_commands=False) as p:
+        p.reset()
+        for i in range(frames):
+            with p.frame(clear=True) as frame:
+                frame.press(dp_controller.Button.A)
+                frame.set_stick(dp_controller.Stick.MAIN, x=0.33 if i % 20 < 10 else 0.66, y=0.5)
+            time.sleep(1 / 60)
+        p.reset()
+        print("{} writes per frame".format(p.writes_per_frame))
+
+
+def test_frame_advance_latency(frames=100):
+    """ Check how long Dolphin takes to show the next frame after the frame advance hot-key is pressed. """
+    with dp_frame_source.ScreenshotFrameSource("NABE01") as frame_source:
+        dp_frames.measure_advance_latency(frame_source, frames=frames)
+    print(dp_hotkeys.get_backend().stats.summary())
+
+
 def test_key_logging():
     """ Check that keyboard input can be successfully logged to a .json file. """
     k = keylog.KeyLog()
@@ -42,8 +64,9 @@ def test_state_map_population():
     """ Check that a state decision map can be properly populated from images and key logs. """
     model = state_model.StateModel(clean_imgs=True)
     model.train()
-    print(model.defaults)
-    print(len(model.state_decision_map))
+    model.export()
+    print(model.index.defaults)
+    print(len(model.index))
 
 
 def test_key2pad():
@@ -60,11 +83,95 @@ def test_key2pad():
 
 def test_process_frame():
     """ Check that the basic Mario Kart AI can process a Dolphin screenshot and choose an action. """
-    agent = mk_naive_agent.MarioKartAgent(os.path.join(helper.get_models_folder(), "naive_model.pickle"))
+    agent = mk_naive_agent.MarioKartAgent(os.path.join(helper.get_models_folder(), "naive_model.npz"))
     while True:
         agent.process_frame()
 
 
+def test_agent_runner(frames=300):
+    """ Check that the basic Mario Kart AI can be run on the asyncio agent runner. """
+    agent = mk_naive_agent.MarioKartAgent(os.path.join(helper.get_models_folder(), "naive_model.npz"))
+    runner = agent_runner.AgentRunner([agent_runner.AgentInstance(agent, advance_key='P')])
+    runner.run(frames)
+    runner.close()
+    print(runner.summary())
+
+
+def test_frame_scheduler(steps=300, depth=1):
+    """ Check that the basic Mario Kart AI can step through the game in lock-step with a paused Dolphin. """
+    agent = mk_naive_agent.MarioKartAgent(os.path.join(helper.get_models_folder(), "naive_model.npz"))
+    scheduler = frame_scheduler.FrameScheduler(agent, depth=depth)
+    print("{:.1f} decisions/s".format(scheduler.run(steps)))
+    print(scheduler.summary())
+
+
+def test_frame_scheduler_skips(steps=12, action_repeat=3, missed_steps=(1, 4, 5)):
+    """ Check that each decision of the frame scheduler is sent for action_repeat captured frames when frames are
+    missed. """
+    class MissingFrameSource:
+        reuses_buffer = False
+
+        def __init__(self):
+            self.step = -1
+
+        def next_frame(self):
+            self.step += 1
+            return None if self.step in missed_steps else self.step
+
+    class CountingAgent:
+        def __init__(self):
+            self.frame_source = MissingFrameSource()
+            self.decisions = 0
+
+        def preprocess(self, frame):
+            return frame
+
+        def act(self, observation):
+            self.decisions += 1
+            return {'decision': self.decisions - 1}
+
+    class RecordingKeyMap:
+        def __init__(self):
+            self.sent = []
+
+        def update(self, keys):
+            self.sent.append(keys['decision'])
+
+    previous = dp_hotkeys.set_backend(dp_hotkeys.RecordingBackend())
+    try:
+        key_map = RecordingKeyMap()
+        scheduler = frame_scheduler.FrameScheduler(CountingAgent(), key_map=key_map, action_repeat=action_repeat)
+        scheduler.run(steps)
+    finally:
+        dp_hotkeys.set_backend(previous)
+    captured = steps - len(missed_steps)
+    assert scheduler.skipped == len(missed_steps)
+    assert key_map.sent == [i // action_repeat for i in range(captured)], key_map.sent
+    print(scheduler.summary())
+
+
+def test_vector_env(num_envs=4, steps=200):
+    """ Check that a neural network can drive several fake Dolphin instances with batched forward passes. """
+    rings, emulators, instances = [], [], []
+    for i in range(num_envs):
+        ring = dp_frame_source.SharedMemoryRingBuffer(create=True)
+        user_dir = os.path.join(helper.get_output_folder(), "fake_dolphin_{}".format(i))
+        emulator = dp_fake_emulator.FakeEmulator(user_dir, ring.name)
+        emulator.start()
+        rings.append(ring)
+        emulators.append(emulator)
+        frame_source = dp_frame_source.SharedMemoryFrameSource(ring.name)
+        instances.append(vector_env.EnvInstance(user_dir, frame_source=frame_source))
+    env = vector_env.VectorEnv(instances)
+    runner = vector_env.VectorRunner(env, vector_env.BatchedNNPolicy(MKCNN(), num_envs, history_length=2))
+    print("{:.1f} decisions/s".format(runner.run(steps)))
+    print(runner.summary())
+    env.close()
+    for emulator, ring in zip(emulators, rings):
+        emulator.stop()
+        ring.close()
+
+
 def test_nn_single_imge():
     model = torch.load(os.path.join(helper.get_models_folder(), "mkrnn.pkl"))
 
@@ -89,6 +196,24 @@ def test_nn(nn_name, history=1):
         agent.process_frame()
 
 
+def test_packed_dataset():
+    """ Check that the packed Mario Kart dataset matches the PNG/json master dataset. """
+    dataset_packer.pack('mario_kart')
+    packed = mk_dataset.PackedMarioKartDataset(history=3)
+    original = mk_dataset.MarioKartDataset(history=3)
+    for idx in (0, 1, len(original) - 1):
+        assert torch.equal(packed[idx][0], original[idx][0])
+        assert torch.equal(packed[idx][1], original[idx][1])
+
+
+def test_agent_benchmark(frames=200):
+    """ Check that the decision loop of every agent can be benchmarked against the fake Dolphin. """
+    suite = agent_benchmark.run_suite(frames=frames)
+    for name, result in suite["results"].items():
+        print("{}: {:.1f} decisions/s".format(name, result["decisions_per_second"]))
+    assert not agent_benchmark.compare(suite, suite)
+
+
 def log_downsample_merge(logging_delay=0.3):
     """ Log key inputs, downsample images, merge to main dataset. """
     k = keylog.KeyLog(logging_delay)
@@ -100,14 +225,23 @@ def log_downsample_merge(logging_delay=0.3):
 # Main function for entering tests
 def main():
     # test_dolphin_controller
+    # test_controller_frames()
+    # test_frame_advance_latency()
     #test_key_logging()
     # test_mario_kart_downsampler()
     # test_state_map_population()
     # test_key2pad()
     # test_process_frame()
+    # test_agent_runner()
+    # test_frame_scheduler()
+    # test_frame_scheduler_skips()
+    # test_vector_env()
     # test_nn_single_imge()
     # log_downsample_merge(logging_delay=0.2)
     # test_nn("mkcnn.pkl", history=3)
+    # test_packed_dataset()
+    # test_agent_benchmark()
+    pass
 
 
 if __name__ == '__main__':